@@ -1,90 +1,290 @@
 import os
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage
-from langchain_core.messages import ToolMessage
+import json
+import time
+import asyncio
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages import SystemMessage, ToolMessage
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph.message import add_messages
 from langgraph.graph import StateGraph, END
-from graph_tools import query_characters_database
-from typing import Annotated,Sequence, TypedDict
+from graph_tools import query_characters_database, current_schema
+from typing import Annotated, Optional, Sequence, TypedDict
 from dotenv import load_dotenv
-from langfuse.callback import CallbackHandler
 from logger import logger
+import metrics
 
 load_dotenv(override=True)
 
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", 30))
+TOOL_CALL_CONCURRENCY = int(os.getenv("TOOL_CALL_CONCURRENCY", 4))
+# draw_mermaid_png renders through a remote web service, so the workflow diagram is only written
+# when a path is configured, as mermaid source unless the path ends with .png
+WORKFLOW_DIAGRAM_PATH = os.getenv("WORKFLOW_DIAGRAM_PATH")
+# Results of earlier tool rounds are cut to this many characters before each LLM call, so the prompt
+# does not grow with every iteration of the loop. The latest round is always sent complete
+CONTEXT_TOOL_RESULT_MAX_CHARS = int(os.getenv("CONTEXT_TOOL_RESULT_MAX_CHARS", 1000))
+# Execution budget of a single workflow run: LLM calls, wall clock seconds and LLM tokens. When one is
+# used up the workflow ends with a partial answer built from the tool results gathered so far
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", 6))
+AGENT_DEADLINE_SECONDS = float(os.getenv("AGENT_DEADLINE_SECONDS", 60))
+AGENT_TOKEN_BUDGET = int(os.getenv("AGENT_TOKEN_BUDGET", 50000))
+
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
+    # LLM calls and tokens used so far and the time.monotonic() deadline, set by the first LLM call
+    steps: int
+    tokens: int
+    deadline: float
+
+def format_tool_result(content: str) -> str:
+    """Readable text of a query tool table, one line per row with the column names, other results unchanged"""
+    lines = content.split("\n")
+    try:
+        columns = json.loads(lines[0])
+        rows = [json.loads(line) for line in lines[1:] if not line.startswith("... truncated")]
+    except (json.JSONDecodeError, IndexError):
+        return content
+    if not isinstance(columns, list):
+        return content
+    formatted = []
+    for row in rows:
+        if len(columns) == 1:
+            formatted.append(f"- {row[0]}")
+        else:
+            formatted.append("- " + ", ".join(f"{column}: {value}" for column, value in zip(columns, row)))
+    formatted += [line for line in lines[1:] if line.startswith("... truncated")]
+    return "\n".join(formatted)
+
+def is_complete_result(content) -> bool:
+    """A tool result with rows, not cut and not an error, which can be returned as the answer"""
+    return isinstance(content, str) and not content.startswith(("Error executing", "No results found")) and \
+        "\n... truncated" not in content
+
+def partial_answer(messages: Sequence[BaseMessage], reason: str) -> AIMessage:
+    """Answer of a workflow stopped by its budget, with the results of the latest tool round if any"""
+    end = len(messages)
+    while end > 0 and not isinstance(messages[end - 1], ToolMessage):
+        end -= 1
+    start = end
+    while start > 0 and isinstance(messages[start - 1], ToolMessage):
+        start -= 1
+    results = [format_tool_result(message.content) for message in messages[start:end] if is_complete_result(message.content)]
+    content = f"I could not finish answering within the {reason} budget."
+    if results:
+        content += " Here is what I found so far:\n" + "\n".join(results)
+    return AIMessage(content=content, response_metadata={"partial": True, "stop_reason": reason})
+
+def budget_exceeded(state: AgentState) -> Optional[str]:
+    """The name of the used up budget, or None"""
+    if state.get("steps", 0) >= AGENT_MAX_STEPS:
+        return "steps"
+    if state.get("tokens", 0) >= AGENT_TOKEN_BUDGET:
+        return "tokens"
+    if state.get("deadline") is not None and time.monotonic() >= state["deadline"]:
+        return "time"
+    return None
+
+def compact_messages(messages: Sequence[BaseMessage], max_chars=CONTEXT_TOOL_RESULT_MAX_CHARS) -> Sequence[BaseMessage]:
+    """
+    Messages to send to the LLM, tool results before the latest tool round are cut at a line boundary
+    to max_chars with a marker. The state keeps the complete messages
+    """
+    latest_round = len(messages)
+    while latest_round > 0 and isinstance(messages[latest_round - 1], ToolMessage):
+        latest_round -= 1
+    compacted = []
+    for i, message in enumerate(messages):
+        content = message.content
+        if i < latest_round and isinstance(message, ToolMessage) and isinstance(content, str) and len(content) > max_chars:
+            cut = content.rfind("\n", 0, max_chars)
+            kept = content[:cut if cut > 0 else max_chars]
+            message = message.model_copy(update={
+                "content": f"{kept}\n... [{len(content) - len(kept)} more characters of this earlier result omitted]"
+            })
+        compacted.append(message)
+    return compacted
 
-def setup_workflow():
+def setup_workflow(llm=None):
+    """Build and compile the agentic workflow, llm defaults to the configured OpenAI chat model"""
     tools = [query_characters_database]
 
-    llm = ChatOpenAI(
-        model=os.getenv("OPENAI_MODEL"),
-        openai_api_key=os.getenv("OPENAI_API_KEY")
-    )
+    if llm is None:
+        # Imported on first use, langchain_openai alone takes about a second to import
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(
+            model=os.getenv("OPENAI_MODEL"),
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            # Token usage is also reported when the workflow is streamed
+            stream_usage=True,
+        )
 
     model = llm.bind_tools(tools)
 
     tools_by_name = {tool.name: tool for tool in tools}
 
-    def call_tool(state: AgentState, config: RunnableConfig):
-        """Tool node"""
-        outputs = []
-        for tool_call in state["messages"][-1].tool_calls:
-            tool_name = tool_call["name"]
-            logger.info(f"Calling tool {tool_name}, request_id {config['metadata']['request_id']}, langfuse_trace_id {config['callbacks'].handlers[0].trace.id}")
-            tool_result = tools_by_name[tool_name].invoke(tool_call["args"])
-            outputs.append(
-                ToolMessage(
-                    content=tool_result,
-                    name=tool_name,
-                    tool_call_id=tool_call["id"],
-                )
-            )
+    async def run_tool_call(tool_call, slots, deadline, config: RunnableConfig):
+        """
+        Run a single tool call with its own timeout, never past the deadline of the workflow
+        The timeout includes waiting for one of the slots of the step. Failures are returned to the LLM as the tool result
+        """
+        tool_name = tool_call["name"]
+        timeout = max(0.0, min(TOOL_CALL_TIMEOUT_SECONDS, deadline - time.monotonic()))
+
+        async def invoke():
+            async with slots:
+                logger.info("Calling tool %s", tool_name, extra={"request_id": config['metadata']['request_id'], "trace_id": config['callbacks'].handlers[0].trace.id})
+                return await tools_by_name[tool_name].ainvoke(tool_call["args"])
+
+        try:
+            tool_result = await asyncio.wait_for(invoke(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error("Tool %s timed out after %.1fs", tool_name, timeout, extra={"request_id": config['metadata']['request_id']})
+            tool_result = f"Error executing query: timed out after {timeout:.0f} seconds, try a simpler query"
+        except Exception as e:
+            logger.error("Tool %s failed: %s", tool_name, e, extra={"request_id": config['metadata']['request_id']})
+            tool_result = f"Error executing tool: {str(e)}"
+        return ToolMessage(
+            content=tool_result,
+            name=tool_name,
+            tool_call_id=tool_call["id"],
+        )
+
+    async def call_tool(state: AgentState, config: RunnableConfig):
+        """
+        Tool node, runs the tool calls of the last LLM message concurrently and keeps their order
+        When every called tool is return_direct and every result is complete, the formatted results are the answer
+        """
+        tool_calls = state["messages"][-1].tool_calls
+        # At most TOOL_CALL_CONCURRENCY calls of this step at a time, concurrent requests do not share the slots
+        slots = asyncio.Semaphore(TOOL_CALL_CONCURRENCY)
+        outputs = list(await asyncio.gather(*(
+            run_tool_call(tool_call, slots, state["deadline"], config) for tool_call in tool_calls
+        )))
+        if all(tools_by_name[tool_call["name"]].return_direct for tool_call in tool_calls) and \
+                all(is_complete_result(output.content) for output in outputs):
+            logger.info("Returning tool results directly", extra={"request_id": config['metadata']['request_id']})
+            metrics.agent_stops.inc(1, "return_direct")
+            outputs.append(AIMessage(content="\n".join(format_tool_result(output.content) for output in outputs)))
         return {"messages": outputs}
 
-    def call_model(state: AgentState, config: RunnableConfig):
-        """LLM node"""
-        response = model.invoke(state["messages"], config)
-        logger.info(f"Calling llm, request_id {config['metadata']['request_id']}, langfuse_trace_id {config['callbacks'].handlers[0].trace.id}")
-        return {"messages": [response]}
+    async def call_model(state: AgentState, config: RunnableConfig):
+        """
+        LLM node, the compact graph schema is sent as system message ahead of the compacted history
+        The call is cut at the deadline of the workflow, which is set by the first call
+        """
+        deadline = state.get("deadline") or time.monotonic() + AGENT_DEADLINE_SECONDS
+        update = {"steps": state.get("steps", 0) + 1, "tokens": state.get("tokens", 0), "deadline": deadline}
+        schema = await current_schema(config['metadata']['request_id'])
+        messages = [SystemMessage(content=f"Schema of the Neo4j graph of Marvel characters:\n{schema}")]
+        messages += compact_messages(state["messages"])
+        try:
+            with metrics.llm_call_seconds.time():
+                response = await asyncio.wait_for(model.ainvoke(messages, config), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning("LLM call reached the deadline of %ss", AGENT_DEADLINE_SECONDS, extra={"request_id": config['metadata']['request_id']})
+            metrics.agent_stops.inc(1, "time")
+            return {**update, "messages": [partial_answer(state["messages"], "time")]}
+        metrics.agent_iterations.inc()
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            metrics.llm_tokens.inc(usage.get("input_tokens", 0), "prompt")
+            metrics.llm_tokens.inc(usage.get("output_tokens", 0), "completion")
+            update["tokens"] += usage.get("total_tokens", 0)
+        logger.info("Calling llm", extra={"request_id": config['metadata']['request_id'], "trace_id": config['callbacks'].handlers[0].trace.id})
+        return {**update, "messages": [response]}
 
     def should_continue(state: AgentState, config: RunnableConfig):
         messages = state["messages"]
         if not messages[-1].tool_calls:
-            logger.info(f"Finishing agentic workflow, request_id {config['metadata']['request_id']}, langfuse_trace_id {config['callbacks'].handlers[0].trace.id}")
+            logger.info("Finishing agentic workflow", extra={"request_id": config['metadata']['request_id'], "trace_id": config['callbacks'].handlers[0].trace.id})
+            return "end"
+        # The tool results would go to another LLM call, which the budget must allow
+        if budget_exceeded(state):
+            return "stop"
+        return "continue"
+
+    def after_tools(state: AgentState, config: RunnableConfig):
+        if isinstance(state["messages"][-1], AIMessage):
             return "end"
+        if budget_exceeded(state):
+            return "stop"
         return "continue"
 
+    def stop(state: AgentState, config: RunnableConfig):
+        """Partial answer node, reached when the budget is used up"""
+        reason = budget_exceeded(state)
+        logger.warning("Stopping agentic workflow, %s budget used up after %s LLM calls and %s tokens", reason, state.get("steps", 0),
+                       state.get("tokens", 0), extra={"request_id": config['metadata']['request_id']})
+        metrics.agent_stops.inc(1, reason)
+        return {"messages": [partial_answer(state["messages"], reason)]}
+
     workflow = StateGraph(AgentState)
 
     workflow.add_node("llm", call_model)
     workflow.add_node("tools",  call_tool)
+    workflow.add_node("stop", stop)
     workflow.set_entry_point("llm")
     workflow.add_conditional_edges(
         "llm",
         should_continue,
         {
             "continue": "tools",
+            "stop": "stop",
             "end": END,
         },
     )
-    workflow.add_edge("tools", "llm")
+    workflow.add_conditional_edges(
+        "tools",
+        after_tools,
+        {
+            "continue": "llm",
+            "stop": "stop",
+            "end": END,
+        },
+    )
+    workflow.add_edge("stop", END)
     graph = workflow.compile()
-    graph.get_graph().draw_mermaid_png(output_file_path='workflow.png')
     
     return graph
 
-langfuse_callback = CallbackHandler(
-    secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
-    public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
-    host=os.getenv("LANGFUSE_HOST"),
-)
+def render_diagram(graph, path):
+    """Write the workflow diagram, failures are logged and do not stop the server"""
+    try:
+        if path.endswith(".png"):
+            graph.get_graph().draw_mermaid_png(output_file_path=path)
+        else:
+            with open(path, "w") as file:
+                file.write(graph.get_graph().draw_mermaid())
+        logger.info("Wrote workflow diagram to %s", path)
+    except Exception as e:
+        logger.error("Could not render workflow diagram to %s: %s", path, e)
+
+_graph = None
+_langfuse_callback = None
 
-graph = setup_workflow()
+def get_graph():
+    """The compiled workflow, built on first use"""
+    global _graph
+    if _graph is None:
+        _graph = setup_workflow()
+        if WORKFLOW_DIAGRAM_PATH:
+            render_diagram(_graph, WORKFLOW_DIAGRAM_PATH)
+    return _graph
+
+def get_langfuse_callback():
+    """The Langfuse callback handler, created on first use"""
+    global _langfuse_callback
+    if _langfuse_callback is None:
+        from langfuse.callback import CallbackHandler
+        _langfuse_callback = CallbackHandler(
+            secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
+            public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
+            host=os.getenv("LANGFUSE_HOST"),
+        )
+    return _langfuse_callback
 
 if __name__ == '__main__':
+    import asyncio
     import uuid
     inputs = {
         "messages": [
@@ -93,15 +293,15 @@ if __name__ == '__main__':
     }
 
     request_id = str(uuid.uuid4())
-    response = graph.invoke(
-        inputs, 
+    response = asyncio.run(get_graph().ainvoke(
+        inputs,
         config={
-            "callbacks": [langfuse_callback],
+            "callbacks": [get_langfuse_callback()],
             "metadata": {
                 "request_id": request_id,
             },
         }
-    )
+    ))
 
-    logger.info(f'Answer for request id {request_id}:')
+    logger.info("Answer for request id %s:", request_id)
     logger.info(response['messages'][-1].content)
@@ -0,0 +1,120 @@
+from dotenv import load_dotenv
+from logger import logger
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import cache_server
+import semantic_cache
+import asyncio
+import json
+import time
+import uuid
+import os
+
+load_dotenv()
+
+# Questions of a batch are deduplicated, the cached answers are fetched with one MGET and the rest run
+# through the workflow at most BATCH_CONCURRENCY at a time, which should stay under the LLM rate limit
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 5000))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+# Jobs are kept in Redis so any replica can answer the polling, progress is saved at most every BATCH_JOB_PROGRESS_SECONDS
+BATCH_JOB_TTL_SECONDS = int(os.getenv("BATCH_JOB_TTL_SECONDS", 24 * 60 * 60))
+BATCH_JOB_PROGRESS_SECONDS = float(os.getenv("BATCH_JOB_PROGRESS_SECONDS", 1))
+
+# References to the running jobs, so their tasks are not garbage collected
+_jobs = set()
+
+async def answer_batch(questions: List[str], answer: Callable[[str, str], Awaitable[Tuple[str, bool]]], request_id=None,
+                       concurrency=BATCH_CONCURRENCY, on_progress: Optional[Callable[[int], Awaitable[None]]] = None) -> List[Dict[str, Any]]:
+    """
+    Answer many questions, failures are reported per question
+
+    Args:
+        questions: Questions in the order of the results
+        answer: Coroutine function answering a question whose exact key missed the cache, called with the question
+            and a request id, returns the answer and whether it came from the cache
+        request_id: Request id used for logging
+        concurrency: Maximum number of questions answered at the same time
+        on_progress: Coroutine function called with the number of answered unique questions
+
+    Returns:
+        List[Dict[str, Any]]: Per question the question, its response or error, and whether it came from the cache
+    """
+    unique = {}
+    for question in questions:
+        unique.setdefault(semantic_cache.normalize_question(question), question)
+    results = {key: {"response": response, "error": None, "cached": True}
+               for key, response in (await semantic_cache.get_exact_many(list(unique.values()), request_id)).items()}
+    misses = [key for key in unique if key not in results]
+    logger.info("Batch of %s questions, %s unique, %s cached", len(questions), len(unique), len(results), extra={"request_id": request_id})
+
+    slots = asyncio.Semaphore(concurrency)
+    done = len(results)
+
+    async def answer_miss(key):
+        nonlocal done
+        async with slots:
+            item_request_id = str(uuid.uuid4())
+            try:
+                response, cached = await answer(unique[key], item_request_id)
+                results[key] = {"response": response, "error": None, "cached": cached}
+            except Exception as e:
+                logger.error("Batch question failed: %s", e, extra={"request_id": item_request_id})
+                results[key] = {"response": None, "error": f"Error processing question: {str(e)}", "cached": False}
+        done += 1
+        if on_progress is not None:
+            await on_progress(done)
+
+    await asyncio.gather(*(answer_miss(key) for key in misses))
+    return [{"question": question, **results[semantic_cache.normalize_question(question)]} for question in questions]
+
+def _job_key(job_id: str) -> str:
+    return f"batch:job:{job_id}"
+
+async def save_job(job: Dict[str, Any]):
+    await cache_server.redis_client.set(_job_key(job["job_id"]), json.dumps(job), ex=BATCH_JOB_TTL_SECONDS)
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    data = await cache_server.redis_client.get(_job_key(job_id))
+    return json.loads(data) if data is not None else None
+
+async def _run_job(job: Dict[str, Any], questions: List[str], answer: Callable[[str, str], Awaitable[Tuple[str, bool]]]):
+    saved_at = time.monotonic()
+
+    async def on_progress(done):
+        nonlocal saved_at
+        job["completed"] = done
+        if time.monotonic() - saved_at >= BATCH_JOB_PROGRESS_SECONDS:
+            saved_at = time.monotonic()
+            await save_job(job)
+
+    try:
+        job["results"] = await answer_batch(questions, answer, job["job_id"], on_progress=on_progress)
+        job.update(status="done", completed=job["unique"])
+    except Exception as e:
+        logger.error("Batch job failed: %s", e, extra={"request_id": job["job_id"]})
+        job.update(status="failed", error=str(e))
+    job["finished_at"] = time.time()
+    try:
+        await save_job(job)
+    except Exception as e:
+        logger.error("Error saving batch job: %s", e, extra={"request_id": job["job_id"]})
+
+async def submit_job(questions: List[str], answer: Callable[[str, str], Awaitable[Tuple[str, bool]]]) -> Dict[str, Any]:
+    """
+    Start answering a batch in the background, the job is polled with get_job until its status is done or failed
+    Jobs do not survive a restart of the replica running them, they stay running until they expire
+    """
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "status": "running",
+        "total": len(questions),
+        "unique": len({semantic_cache.normalize_question(question) for question in questions}),
+        "completed": 0,
+        "submitted_at": time.time(),
+        "finished_at": None,
+        "results": None,
+    }
+    await save_job(job)
+    task = asyncio.create_task(_run_job(job, questions, answer))
+    _jobs.add(task)
+    task.add_done_callback(_jobs.discard)
+    return job
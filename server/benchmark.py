@@ -0,0 +1,470 @@
+"""
+Offline end-to-end benchmark of the server, runs without OpenAI, Langfuse, Redis or Neo4j
+
+The external services are replaced by local stand-ins: a scripted chat model emitting deterministic
+tool calls after a configurable latency, an in-process Redis, the in-memory graph snapshot built from
+marvel_dataset.json for the fixed query shapes and a replay layer returning recorded outputs for the
+LLM generated Cypher. Requests go through the FastAPI app in-process.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --requests 500 --concurrency 32 --llm-latency 0.2
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+"""
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from types import SimpleNamespace
+from typing import Any, Dict, List
+import numpy as np
+import argparse
+import asyncio
+import logging
+import resource
+import httpx
+import json
+import time
+import uuid
+import os
+
+DATASET_PATH = os.path.join(os.path.dirname(__file__), 'marvel_dataset.json')
+# Query of the scripted tool call, {team} is the question as a string literal so every question runs
+# its own query instead of being served from the tool result cache
+DEFAULT_CYPHER_QUERY = (
+    'MATCH (c:Character)-[r:MEMBER_OF]->(t:Team {{name: {team}}}) WHERE r.confidence > 0.5 '
+    'RETURN c.name as name, r.confidence as confidence ORDER BY r.confidence DESC'
+)
+# Metrics compared against the baseline, latencies regress when they grow and throughput when it drops
+LATENCY_METRICS = ("p50_ms", "p95_ms", "p99_ms")
+THROUGHPUT_METRICS = ("throughput_rps",)
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of redis.asyncio used by the server
+    Values are returned as bytes like a client created without decode_responses
+    """
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self.expired_keys = 0
+
+    @staticmethod
+    def _key(key) -> str:
+        return key.decode("utf-8") if isinstance(key, bytes) else str(key)
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+
+    def _get(self, key):
+        key = self._key(key)
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            self.expired_keys += 1
+        return self._data.get(key)
+
+    def _expire(self, key, seconds):
+        if seconds:
+            self._expires[self._key(key)] = time.monotonic() + seconds
+        else:
+            self._expires.pop(self._key(key), None)
+
+    async def ping(self):
+        return True
+
+    async def get(self, key):
+        return self._get(key)
+
+    async def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys, *args]
+        return [self._get(key) for key in keys]
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self._get(key) is not None:
+            return None
+        self._data[self._key(key)] = self._bytes(value)
+        self._expire(key, ex if ex else (px / 1000 if px else None))
+        return True
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self._data[self._key(key)]
+                self._expires.pop(self._key(key), None)
+                deleted += 1
+        return deleted
+
+    async def incr(self, key):
+        value = int(self._get(key) or 0) + 1
+        self._data[self._key(key)] = self._bytes(value)
+        return value
+
+    async def expire(self, key, seconds):
+        self._expire(key, seconds)
+        return True
+
+    async def hset(self, key, field, value):
+        fields = self._get(key)
+        if fields is None:
+            fields = self._data[self._key(key)] = {}
+        fields[self._key(field)] = self._bytes(value)
+        return 1
+
+    async def hdel(self, key, *fields):
+        values = self._get(key) or {}
+        return sum(values.pop(self._key(field), None) is not None for field in fields)
+
+    async def hscan_iter(self, key, count=None):
+        for field, value in list((self._get(key) or {}).items()):
+            yield field.encode("utf-8"), value
+
+    async def eval(self, script, numkeys, *args):
+        # The only script the server runs is the compare-and-delete release of single_flight
+        import single_flight
+        if script != single_flight._RELEASE_SCRIPT:
+            raise NotImplementedError("LocalRedis only evaluates the single flight release script")
+        key, token = args[0], args[1]
+        if self._get(key) == self._bytes(token):
+            return await self.delete(key)
+        return 0
+
+    async def publish(self, channel, message):
+        queues = self._subscribers.get(self._key(channel), [])
+        for subscriber in queues:
+            subscriber.put_nowait({"type": "message", "channel": channel, "data": self._bytes(message)})
+        return len(queues)
+
+    def pubsub(self, ignore_subscribe_messages=True):
+        return LocalPubSub(self)
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    async def info(self, section=None):
+        return {"evicted_keys": 0, "expired_keys": self.expired_keys}
+
+    async def close(self):
+        pass
+
+class LocalPubSub:
+    def __init__(self, redis: LocalRedis):
+        self._redis = redis
+        self._queue = asyncio.Queue()
+        self._channels = []
+
+    async def subscribe(self, channel):
+        self._channels.append(LocalRedis._key(channel))
+        self._redis._subscribers.setdefault(self._channels[-1], []).append(self._queue)
+
+    async def listen(self):
+        while True:
+            yield await self._queue.get()
+
+    async def reset(self):
+        for channel in self._channels:
+            self._redis._subscribers[channel].remove(self._queue)
+        self._channels = []
+
+class LocalPipeline:
+    def __init__(self, redis: LocalRedis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    async def execute(self):
+        results = [await getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic stand-in for ChatOpenAI: answers a question with one query_characters_database
+    tool call, then answers with a summary of the tool result, each after `latency` seconds
+    The Cypher of the tool call is cypher_query formatted with the question as team
+    """
+    latency: float = 0.0
+    cypher_query: str = DEFAULT_CYPHER_QUERY
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages) -> ChatResult:
+        if isinstance(messages[-1], ToolMessage):
+            message = AIMessage(content=f"According to the database: {messages[-1].content[:500]}")
+        else:
+            question = next(message.content for message in reversed(messages) if isinstance(message, HumanMessage))
+            message = AIMessage(
+                content="Querying the database.",
+                tool_calls=[{"name": "query_characters_database",
+                             "args": {"cypher_query": self.cypher_query.format(team=json.dumps(question))},
+                             "id": f"call_{uuid.uuid4().hex[:12]}"}],
+            )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._reply(messages)
+
+class TraceCallback(BaseCallbackHandler):
+    """Stand-in for the Langfuse callback handler, the agent only reads the trace id"""
+    trace = SimpleNamespace(id="benchmark")
+
+class ReplayNeo4j:
+    """
+    Stand-in for graph_tools.read_transaction, replays recorded query tool outputs after `latency` seconds
+    The fixed query shapes never get here, they are served by the in-memory snapshot
+    """
+    def __init__(self, responses: Dict[str, str], default: str, latency: float = 0.0):
+        import graph_tools
+        self._graph_tools = graph_tools
+        self.responses = {graph_tools.normalize_cypher(query): output for query, output in responses.items()}
+        self.default = default
+        self.latency = latency
+
+    async def read_transaction(self, work, *args, query, fetch_size=None, rows=len, **kwargs):
+        await asyncio.sleep(self.latency)
+        if work is self._graph_tools._run_guarded:
+            output = self.responses.get(self._graph_tools.normalize_cypher(args[0]), self.default)
+            return output, output.count("\n")
+        raise RuntimeError(f"No recorded response for {getattr(work, '__name__', work)}")
+
+def load_characters(path: str = DATASET_PATH) -> List[Dict[str, Any]]:
+    from create_knowledge_graph import iter_characters
+    return list(iter_characters(path))
+
+def synthetic_characters(characters: List[Dict[str, Any]], count: int) -> List[Dict[str, Any]]:
+    """count characters cycling through the dataset with distinct names"""
+    return [
+        {**characters[i % len(characters)], "character_name": f"{characters[i % len(characters)]['character_name']} {i}"}
+        for i in range(count)
+    ]
+
+def snapshot_from_characters(characters: List[Dict[str, Any]], version=None):
+    """Graph snapshot holding what ingestion would write to Neo4j for the characters"""
+    from create_knowledge_graph import normalize_characters
+    from graph_snapshot import GraphSnapshot
+    rows = normalize_characters(characters)
+    nodes = [("Character", row["name"], row["text_snippet"]) for row in rows["characters"]]
+    nodes += [(label, row["name"], None) for label, kind in (("Team", "teams"), ("Gene", "genes"), ("Power", "powers"))
+              for row in rows[kind]]
+    relationships = [("MEMBER_OF", row["character"], row["team"], row["confidence"]) for row in rows["member_of"]]
+    relationships += [("HAS_MUTATION", row["character"], row["gene"], row["confidence"]) for row in rows["has_mutation"]]
+    relationships += [("POSSESSES_POWER", row["character"], row["power"], row["confidence"]) for row in rows["possesses_power"]]
+    relationships += [("CONFERS", row["gene"], row["power"], row["confidence"]) for row in rows["confers"]]
+    return GraphSnapshot(nodes, relationships, version)
+
+async def install_stand_ins(args):
+    """Point the server modules at the local stand-ins"""
+    import agent
+    import cache_server
+    import graph_tools
+    import semantic_cache
+    import single_flight
+    import server
+    from name_index import NameIndex
+
+    redis = LocalRedis()
+    for module in (cache_server, semantic_cache, single_flight):
+        module.redis_client = redis
+
+    semantic_cache.embedder = semantic_cache.HashingEmbedder(semantic_cache.SEMANTIC_CACHE_DIMENSIONS)
+    semantic_cache.index = semantic_cache.create_index()
+
+    characters = load_characters()
+    version = await cache_server.get_version()
+    graph_tools.snapshot = snapshot_from_characters(characters, version)
+    graph_tools.names = NameIndex(graph_tools.snapshot.node_names(), version)
+    graph_tools._schema, graph_tools._schema_version = graph_tools.default_schema(), version
+    team = graph_tools.snapshot.team_members("X-Men", 0.5)
+    default_output = "\n".join([json.dumps(["name", "confidence"])] + [json.dumps([row["name"], row["confidence"]]) for row in team])
+    responses = {}
+    if args.responses:
+        with open(args.responses) as file:
+            responses = json.load(file)
+    graph_tools.read_transaction = ReplayNeo4j(responses, default_output, args.neo4j_latency).read_transaction
+
+    agent._langfuse_callback = TraceCallback()
+    agent._graph = agent.setup_workflow(llm=ScriptedChatModel(latency=args.llm_latency))
+    server.startup["ready"] = True
+    return characters
+
+def rss_mb() -> float:
+    """Current resident set size, from /proc where available"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if os.uname().sysname == "Darwin" else peak / 2 ** 10
+
+async def run_load(call, requests: int, concurrency: int) -> Dict[str, float]:
+    """
+    Run call(i) for i in range(requests) from `concurrency` concurrent workers
+
+    Returns:
+        Dict[str, float]: Latency percentiles, throughput, errors and memory
+    """
+    latencies = []
+    errors = 0
+    indexes = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            start_time = time.perf_counter()
+            try:
+                ok = await call(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start_time)
+            errors += 0 if ok else 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    milliseconds = np.asarray(latencies) * 1000
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 3),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 3),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "rss_mb": round(rss_mb(), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+async def run_workloads(args) -> Dict[str, Dict[str, float]]:
+    import semantic_cache
+    import server
+
+    characters = await install_stand_ins(args)
+    names = [character["character_name"] for character in characters]
+    transport = httpx.ASGITransport(app=server.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+        async def ask(question):
+            response = await client.post("/question", json={"question": question})
+            return response.status_code == 200
+
+        cached_question = "Which genes do the members of the X-Men share?"
+        await semantic_cache.store(cached_question, "They all carry Gene X.")
+        workloads = {
+            "cache_hit": lambda i: ask(cached_question),
+            "cache_miss": lambda i: ask(f"Which genes do the members of team {uuid.uuid4().hex} share?"),
+            "fast_path": lambda i: ask(f"What are {names[i % len(names)]} powers?"),
+            "graph_lookup": lambda i: graph(client, names[i % len(names)], depth=1),
+            "graph_neighborhood": lambda i: graph(client, names[i % len(names)], depth=2),
+        }
+        for name, call in workloads.items():
+            if args.workloads and name not in args.workloads:
+                continue
+            results[name] = await run_load(call, args.requests, args.concurrency)
+            print(f"{name}: {results[name]}", flush=True)
+
+    if not args.workloads or "ingestion" in args.workloads:
+        results["ingestion"] = await run_load(lambda i: ingest(characters, args.ingestion_characters), args.ingestion_runs, 1)
+        print(f"ingestion: {results['ingestion']}", flush=True)
+    return results
+
+async def graph(client, character, depth):
+    response = await client.get(f"/graph/{character}", params={"depth": depth})
+    return response.status_code == 200
+
+async def ingest(characters, count):
+    """
+    In-process part of ingestion: normalizing the records into rows and building the snapshot and
+    name index the server loads from the graph. Writes to Neo4j are not covered
+    """
+    from name_index import NameIndex
+    snapshot = snapshot_from_characters(synthetic_characters(characters, count))
+    NameIndex(snapshot.node_names())
+    return True
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """Print the change of every metric against the baseline and return the regressions beyond tolerance"""
+    regressions = []
+    for workload, metrics in results.items():
+        if workload not in baseline:
+            continue
+        if metrics["errors"] > baseline[workload].get("errors", 0):
+            print(f"{workload:20} errors          {baseline[workload].get('errors', 0):>10} -> {metrics['errors']:>10} REGRESSION")
+            regressions.append(f"{workload} errors")
+        for metric in LATENCY_METRICS + THROUGHPUT_METRICS:
+            before, after = baseline[workload].get(metric), metrics.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = change > tolerance if metric in LATENCY_METRICS else change < -tolerance
+            print(f"{workload:20} {metric:15} {before:>10} -> {after:>10} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{workload} {metric}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the server with local stand-ins for the external services")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per workload")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per scripted chat model call")
+    parser.add_argument("--neo4j-latency", type=float, default=0.005, help="Seconds per replayed query tool call")
+    parser.add_argument("--responses", help="JSON file mapping Cypher queries to recorded query tool outputs")
+    parser.add_argument("--ingestion-characters", type=int, default=5000, help="Characters per ingestion run")
+    parser.add_argument("--ingestion-runs", type=int, default=5)
+    parser.add_argument("--workloads", nargs="*", help="Workloads to run, all by default: cache_hit cache_miss "
+                                                        "fast_path graph_lookup graph_neighborhood ingestion")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change tolerated before a regression")
+    parser.add_argument("--save-baseline", help="Write the results as the new baseline")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    from logger import logger
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+
+    results = asyncio.run(run_workloads(args))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 from dotenv import load_dotenv
 from logger import logger
-import redis
+from local_cache import LRUCache
+from collections import Counter
+import redis.asyncio as redis
+import asyncio
+import uuid
+import time
+import zlib
 import os
 
 load_dotenv()
@@ -8,45 +14,236 @@ load_dotenv()
 redis_host = os.getenv("REDIS_HOST")
 redis_port = os.getenv("REDIS_PORT")
 
-logger.info(f'Connecting to redis database at {redis_host}:{redis_port}')
-try:
-    pool = redis.ConnectionPool(
-        host=redis_host,
-        port=redis_port,
-        db=0,
-        decode_responses=True
-    )
-
-    redis_client = redis.Redis(connection_pool=pool)
-
-    redis_client.ping()
-except Exception as e:
-    logger.error(f'Error on connecting to redis: {e}')
-    logger.exception(e)
-    exit(1)
-logger.info(f'Connected to redis')
-
-def set_key_value(key, value, request_id=None):
-    """Set a key-value pair in Redis"""
+# Cached entries live under cache:v{version}:, ingestion increments the version so every
+# entry written against the previous graph is invalidated at once and left to expire
+CACHE_VERSION_KEY = "cache:version"
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 24 * 60 * 60))
+CACHE_VERSION_REFRESH_SECONDS = float(os.getenv("CACHE_VERSION_REFRESH_SECONDS", 5))
+CACHE_COMPRESSION_MIN_BYTES = int(os.getenv("CACHE_COMPRESSION_MIN_BYTES", 512))
+
+# In-process L1 cache in front of Redis, replicas keep each other's L1 consistent through
+# messages "{replica_id}|key|{namespaced key}" and "{replica_id}|version|{version}"
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", 10000))
+CACHE_L1_TTL_SECONDS = float(os.getenv("CACHE_L1_TTL_SECONDS", 60))
+
+# One byte header in front of every stored value
+_RAW = b"r"
+_COMPRESSED = b"z"
+
+pool = redis.ConnectionPool(
+    host=redis_host,
+    port=redis_port,
+    db=0,
+)
+
+redis_client = redis.Redis(connection_pool=pool)
+
+stats = Counter()
+local_cache = LRUCache(CACHE_L1_MAX_ENTRIES, CACHE_L1_TTL_SECONDS)
+# Every L1 cache backed by this Redis namespace, cleared together when the version moves
+local_caches = {"answers": local_cache}
+# Functions called with the new version when the version moves, to reload derived data in the background
+version_callbacks = []
+
+replica_id = uuid.uuid4().hex
+_listener_task = None
+
+_version = None
+_version_checked_at = 0.0
+
+async def connect():
+    """Verify the connection to Redis, connections are opened lazily by the pool"""
+    logger.info("Connecting to redis database at %s:%s", redis_host, redis_port)
+    try:
+        await redis_client.ping()
+    except Exception as e:
+        logger.error("Error on connecting to redis: %s", e)
+        logger.exception(e)
+        raise
+    logger.info("Connected to redis")
+
+async def close():
+    """Stop the invalidation listener, close the Redis client and release the pool connections"""
+    if _listener_task is not None:
+        _listener_task.cancel()
+    await redis_client.close()
+    await pool.disconnect()
+
+def _set_version(version):
+    global _version, _version_checked_at
+    changed = version != _version
+    if changed:
+        for cache in local_caches.values():
+            cache.clear()
+    _version = version
+    _version_checked_at = time.monotonic()
+    if changed:
+        for callback in version_callbacks:
+            callback(version)
+
+async def get_version():
+    """Current cache namespace version, re-read from Redis at most every CACHE_VERSION_REFRESH_SECONDS"""
+    if _version is None or time.monotonic() - _version_checked_at >= CACHE_VERSION_REFRESH_SECONDS:
+        try:
+            _set_version(int(await redis_client.get(CACHE_VERSION_KEY) or 0))
+        except Exception as e:
+            logger.error("Error reading cache version: %s", e)
+            if _version is None:
+                return 0
+    return _version
+
+async def bump_version():
+    """Move the cache to a new namespace, invalidating every cached entry"""
+    _set_version(int(await redis_client.incr(CACHE_VERSION_KEY)))
+    stats["invalidations"] += 1
+    await _publish("version", _version)
+    logger.info("Cache version bumped to %s", _version)
+    return _version
+
+async def namespaced(key):
+    """Prefix a key with the current cache namespace"""
+    return f"cache:v{await get_version()}:{key}"
+
+async def _publish(kind, value):
     try:
-        redis_client.set(key, value)
-        logger.info(f"Successfully added key in redis cache, request_id {request_id}")
+        await redis_client.publish(CACHE_INVALIDATION_CHANNEL, f"{replica_id}|{kind}|{value}")
+    except Exception as e:
+        logger.error("Error publishing cache invalidation: %s", e)
+
+def _handle_invalidation(message: str):
+    origin, kind, value = message.split("|", 2)
+    if origin == replica_id:
+        return
+    if kind == "key":
+        for cache in local_caches.values():
+            cache.pop(value)
+    elif kind == "version":
+        _set_version(int(value))
+        stats["invalidations"] += 1
+
+async def _listen_for_invalidations():
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message and message["type"] == "message":
+                    _handle_invalidation(message["data"].decode("utf-8"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Cache invalidation listener failed, resubscribing: %s", e)
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+def start_invalidation_listener():
+    """Subscribe to invalidations published by other replicas and by ingestion"""
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.create_task(_listen_for_invalidations())
+
+def encode_value(value: str) -> bytes:
+    """Serialize a value for Redis, compressing it when it is large enough to benefit"""
+    data = value.encode("utf-8")
+    if len(data) >= CACHE_COMPRESSION_MIN_BYTES:
+        return _COMPRESSED + zlib.compress(data)
+    return _RAW + data
+
+def decode_value(data: bytes) -> str:
+    """Inverse of encode_value"""
+    if data[:1] == _COMPRESSED:
+        return zlib.decompress(data[1:]).decode("utf-8")
+    return data[1:].decode("utf-8")
+
+def register_local_cache(name, cache: LRUCache):
+    """Register an additional L1 cache so it is invalidated together with the answer cache"""
+    local_caches[name] = cache
+
+def register_version_callback(callback):
+    """Call callback(version) whenever the version moves, from the event loop, it must not block"""
+    version_callbacks.append(callback)
+
+async def set_key_value(key, value, request_id=None, ttl=CACHE_TTL_SECONDS, l1=local_cache):
+    """
+    Set a key-value pair in Redis under the current namespace, expiring after ttl seconds
+    The value is also kept in the local L1 cache and dropped from the L1 cache of other replicas
+    """
+    try:
+        namespaced_key = await namespaced(key)
+        await redis_client.set(namespaced_key, encode_value(value), ex=ttl)
+        l1.set(namespaced_key, value, ttl=min(ttl, l1.ttl) if ttl and l1.ttl else ttl)
+        await _publish("key", namespaced_key)
+        stats["sets"] += 1
+        logger.info("Successfully added key in redis cache", extra={"request_id": request_id})
         return True
     except Exception as e:
-        logger.error(f"Error setting key '{key}': {e}, request_id {request_id}")
+        stats["errors"] += 1
+        logger.error("Error setting key '%s': %s", key, e, extra={"request_id": request_id})
         return False
 
-def get_value(key, request_id=None):
-    """Get value for a key from Redis"""
+async def get_value(key, request_id=None, l1=local_cache):
+    """Get value for a key under the current namespace from the local L1 cache or from Redis"""
     try:
-        value = redis_client.get(key)
+        namespaced_key = await namespaced(key)
+        value = l1.get(namespaced_key)
+        if value is not None:
+            stats["l1_hits"] += 1
+            return value
+        value = await redis_client.get(namespaced_key)
+        if value is None:
+            return None
+        value = decode_value(value)
+        l1.set(namespaced_key, value)
         return value
     except Exception as e:
-        logger.error(f"Error getting value for key '{key}': {e}, request_id {request_id}")
+        stats["errors"] += 1
+        logger.error("Error getting value for key '%s': %s", key, e, extra={"request_id": request_id})
         return None
-    
+
+async def get_values(keys, request_id=None, l1=local_cache):
+    """
+    Get the values of many keys under the current namespace, from the local L1 cache or with a single Redis MGET
+
+    Returns:
+        List[Optional[str]]: The value of each key, None for missing keys
+    """
+    try:
+        namespaced_keys = [await namespaced(key) for key in keys]
+        values = [l1.get(namespaced_key) for namespaced_key in namespaced_keys]
+        stats["l1_hits"] += sum(value is not None for value in values)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            for i, data in zip(missing, await redis_client.mget([namespaced_keys[i] for i in missing])):
+                if data is not None:
+                    values[i] = decode_value(data)
+                    l1.set(namespaced_keys[i], values[i])
+        return values
+    except Exception as e:
+        stats["errors"] += 1
+        logger.error("Error getting values for %s keys: %s", len(keys), e, extra={"request_id": request_id})
+        return [None] * len(keys)
+
+async def cache_stats():
+    """Hit/miss counters of this process together with the eviction counters of the Redis server"""
+    result = dict(stats)
+    result["version"] = await get_version()
+    result["l1"] = {name: cache.stats() for name, cache in local_caches.items()}
+    try:
+        info = await redis_client.info("stats")
+        result["redis_evicted_keys"] = info.get("evicted_keys", 0)
+        result["redis_expired_keys"] = info.get("expired_keys", 0)
+    except Exception as e:
+        logger.error("Error reading redis stats: %s", e)
+    return result
+
 if __name__ == '__main__':
-    set_key_value("how are you doing?", "good")
-    logger.info('get_value: ', get_value('how are you doing?'))
-    logger.info('get_value: ', get_value('how?'))
-    
\ No newline at end of file
+    async def _demo():
+        await connect()
+        await set_key_value("how are you doing?", "good")
+        logger.info("get_value: %s", await get_value('how are you doing?'))
+        logger.info("get_value: %s", await get_value('how?'))
+        await close()
+
+    asyncio.run(_demo())
@@ -1,5 +1,10 @@
 from neo4j import GraphDatabase
-from typing import Dict, Any
+from cache_server import CACHE_VERSION_KEY, CACHE_INVALIDATION_CHANNEL
+from name_index import normalize_name
+from typing import Dict, Any, Iterable, Iterator, List
+from itertools import islice
+import hashlib
+import redis
 from dotenv import load_dotenv
 from tqdm import tqdm
 import json
@@ -8,6 +13,300 @@ import time
 
 load_dotenv()
 
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_READ_SIZE = 64 * 1024
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+
+# Bulk ingestion statements, nodes are merged before the relationships that MATCH them
+BULK_STATEMENTS = [
+    ("characters", """
+        UNWIND $rows AS row
+        MERGE (c:Character {name: row.name})
+        SET c.name_normalized = row.name_normalized, c.text_snippet = row.text_snippet, c.content_hash = row.content_hash
+    """),
+    ("teams", """
+        UNWIND $rows AS row
+        MERGE (n:Team {name: row.name})
+        SET n.name_normalized = row.name_normalized
+    """),
+    ("genes", """
+        UNWIND $rows AS row
+        MERGE (n:Gene {name: row.name})
+        SET n.name_normalized = row.name_normalized
+    """),
+    ("powers", """
+        UNWIND $rows AS row
+        MERGE (n:Power {name: row.name})
+        SET n.name_normalized = row.name_normalized
+    """),
+    ("member_of", """
+        UNWIND $rows AS row
+        MATCH (c:Character {name: row.character})
+        MATCH (t:Team {name: row.team})
+        MERGE (c)-[r:MEMBER_OF]->(t)
+        SET r.confidence = row.confidence
+    """),
+    ("has_mutation", """
+        UNWIND $rows AS row
+        MATCH (c:Character {name: row.character})
+        MATCH (g:Gene {name: row.gene})
+        MERGE (c)-[r:HAS_MUTATION]->(g)
+        SET r.confidence = row.confidence
+    """),
+    ("possesses_power", """
+        UNWIND $rows AS row
+        MATCH (c:Character {name: row.character})
+        MATCH (p:Power {name: row.power})
+        MERGE (c)-[r:POSSESSES_POWER]->(p)
+        SET r.confidence = row.confidence
+    """),
+    ("confers", """
+        UNWIND $rows AS row
+        MATCH (g:Gene {name: row.gene})
+        MATCH (p:Power {name: row.power})
+        MERGE (g)-[r:CONFERS]->(p)
+        SET r.confidence = row.confidence,
+            r.declared_by = [name IN coalesce(r.declared_by, []) WHERE NOT name IN row.declared_by] + row.declared_by
+    """),
+]
+
+# Incremental sync statements, CONFERS edges are shared between characters and are only
+# removed once no character declares them anymore
+READ_CONTENT_HASHES = """
+    UNWIND $names AS name
+    MATCH (c:Character {name: name})
+    RETURN c.name AS name, c.content_hash AS content_hash
+"""
+READ_CHARACTER_NAMES = "MATCH (c:Character) RETURN c.name AS name"
+DETACH_CHARACTERS = """
+    UNWIND $names AS name
+    MATCH (c:Character {name: name})
+    OPTIONAL MATCH (c)-[r:MEMBER_OF|HAS_MUTATION|POSSESSES_POWER]->()
+    DELETE r
+    WITH collect(DISTINCT name) AS names
+    MATCH (:Gene)-[r:CONFERS]->(:Power)
+    WHERE any(declared IN r.declared_by WHERE declared IN names)
+    SET r.declared_by = [declared IN r.declared_by WHERE NOT declared IN names]
+    WITH r WHERE size(r.declared_by) = 0
+    DELETE r
+"""
+DELETE_CHARACTERS = """
+    UNWIND $names AS name
+    MATCH (c:Character {name: name})
+    DETACH DELETE c
+"""
+DELETE_ORPHANS = """
+    MATCH (n)
+    WHERE (n:Team OR n:Gene OR n:Power) AND NOT (n)--()
+    DELETE n
+"""
+
+# Nodes written before name_normalized existed, or by the single character path, get it backfilled
+READ_UNNORMALIZED_NAMES = """
+    MATCH (n)
+    WHERE (n:Character OR n:Team OR n:Gene OR n:Power) AND n.name_normalized IS NULL
+    RETURN elementId(n) AS id, n.name AS name
+"""
+SET_NORMALIZED_NAMES = """
+    UNWIND $rows AS row
+    MATCH (n) WHERE elementId(n) = row.id
+    SET n.name_normalized = row.name_normalized
+"""
+
+def character_hash(character_data: Dict[str, Any]) -> str:
+    """Content hash of a character record, independent of key order"""
+    canonical = json.dumps(character_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def _named_confidence(item, default_confidence=0.0):
+    """Return (name, confidence) for an entry given either as {name, confidence} or as a plain name"""
+    if isinstance(item, dict):
+        return item.get("name"), item.get("confidence", default_confidence)
+    return item, 1.0
+
+def normalize_characters(characters: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Normalize character records into deduplicated node and relationship rows for bulk ingestion
+    Follows the same rules as Neo4jDataIngestion.ingest_character_data, a later record overrides
+    the properties written by an earlier one
+
+    Args:
+        characters: Character records in the marvel_dataset.json format
+
+    Returns:
+        Dict[str, List[Dict[str, Any]]]: Rows keyed by the names used in BULK_STATEMENTS
+    """
+    characters_rows = {}
+    teams, genes, powers = {}, {}, {}
+    member_of, has_mutation, possesses_power, confers = {}, {}, {}, {}
+
+    for character_data in characters:
+        character_name = character_data["character_name"]
+        characters_rows[character_name] = {
+            "name": character_name,
+            "name_normalized": normalize_name(character_name),
+            "text_snippet": character_data.get("text_snippet", ""),
+            "content_hash": character_hash(character_data),
+        }
+
+        affiliation = character_data.get("affiliation")
+        team_name, confidence = None, None
+        if affiliation and isinstance(affiliation, dict):
+            team_name, confidence = _named_confidence(affiliation)
+        elif affiliation and isinstance(affiliation, str) and affiliation != "Unknown":
+            team_name, confidence = affiliation, 1.0
+        if team_name:
+            teams[team_name] = {"name": team_name, "name_normalized": normalize_name(team_name)}
+            member_of[(character_name, team_name)] = {
+                "character": character_name, "team": team_name, "confidence": confidence
+            }
+
+        for gene_data in character_data.get("known_mutations_genes", []):
+            gene_name, confidence = _named_confidence(gene_data)
+            if gene_name:
+                genes[gene_name] = {"name": gene_name, "name_normalized": normalize_name(gene_name)}
+                has_mutation[(character_name, gene_name)] = {
+                    "character": character_name, "gene": gene_name, "confidence": confidence
+                }
+
+        for power_data in character_data.get("primary_powers", []):
+            power_name, confidence = _named_confidence(power_data)
+            if power_name:
+                powers[power_name] = {"name": power_name, "name_normalized": normalize_name(power_name)}
+                possesses_power[(character_name, power_name)] = {
+                    "character": character_name, "power": power_name, "confidence": confidence
+                }
+
+        for relationship in character_data.get("gene_power_relationships", []):
+            gene_name = relationship.get("gene")
+            power_name = relationship.get("confers")
+            if gene_name and power_name:
+                genes[gene_name] = {"name": gene_name, "name_normalized": normalize_name(gene_name)}
+                powers[power_name] = {"name": power_name, "name_normalized": normalize_name(power_name)}
+                declared_by = confers.get((gene_name, power_name), {}).get("declared_by", [])
+                if character_name not in declared_by:
+                    declared_by = declared_by + [character_name]
+                confers[(gene_name, power_name)] = {
+                    "gene": gene_name, "power": power_name, "confidence": relationship.get("confidence", 0.0),
+                    "declared_by": declared_by,
+                }
+
+    return {
+        "characters": list(characters_rows.values()),
+        "teams": list(teams.values()),
+        "genes": list(genes.values()),
+        "powers": list(powers.values()),
+        "member_of": list(member_of.values()),
+        "has_mutation": list(has_mutation.values()),
+        "possesses_power": list(possesses_power.values()),
+        "confers": list(confers.values()),
+    }
+
+class _JsonStreamReader:
+    """Incremental JSON tokenizer over a text file, holds only the unparsed tail of the file in memory"""
+    _decoder = json.JSONDecoder()
+    _NUMBER_CHARS = '0123456789+-.eE'
+
+    def __init__(self, file, read_size: int = DEFAULT_READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it, '' at end of file"""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, token: str):
+        found = self.peek()
+        if found != token:
+            raise ValueError(f"Expected '{token}' in JSON stream, found '{found or 'EOF'}'")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value, reading more of the file until it is complete"""
+        first = self.peek()
+        if first == '-' or first.isdigit():
+            # A number is complete only once a character that cannot continue it follows, e.g. "12." may be "12.5"
+            while not self.text[self.pos:].lstrip(self._NUMBER_CHARS) and self._fill():
+                pass
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.text, self.pos)
+                self.pos = end
+                return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def iter_characters(file_path: str, read_size: int = DEFAULT_READ_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Yield character records one at a time without loading the whole file
+    Reads either JSON Lines (one character per line) or a JSON document with a top level "characters" array
+
+    Args:
+        file_path (str): Path to a .json, .jsonl or .ndjson file
+        read_size (int): Number of characters read from the file at a time
+
+    Yields:
+        Dict[str, Any]: A single character record
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        if file_path.endswith(JSON_LINES_EXTENSIONS):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        reader = _JsonStreamReader(file, read_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == "characters":
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.peek() == ']':
+                            reader.pos += 1
+                            break
+                        reader.expect(',')
+            else:
+                reader.value()
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
+
+def iter_batches(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    """Group an iterable into lists of at most batch_size items"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
 class Neo4jDataIngestion:
     def __init__(self):
         uri = os.getenv("NEO4J_URI")
@@ -24,13 +323,17 @@ class Neo4jDataIngestion:
             session.run("MATCH (n) DETACH DELETE n")
     
     def create_constraints(self):
-        """Create unique constraints for node properties"""
+        """Create unique constraints for node names and indexes for their normalized form"""
         with self.driver.session() as session:
             constraints = [
                 "CREATE CONSTRAINT character_name IF NOT EXISTS FOR (c:Character) REQUIRE c.name IS UNIQUE",
                 "CREATE CONSTRAINT gene_name IF NOT EXISTS FOR (g:Gene) REQUIRE g.name IS UNIQUE",
                 "CREATE CONSTRAINT power_name IF NOT EXISTS FOR (p:Power) REQUIRE p.name IS UNIQUE",
-                "CREATE CONSTRAINT team_name IF NOT EXISTS FOR (t:Team) REQUIRE t.name IS UNIQUE"
+                "CREATE CONSTRAINT team_name IF NOT EXISTS FOR (t:Team) REQUIRE t.name IS UNIQUE",
+                "CREATE INDEX character_name_normalized IF NOT EXISTS FOR (c:Character) ON (c.name_normalized)",
+                "CREATE INDEX gene_name_normalized IF NOT EXISTS FOR (g:Gene) ON (g.name_normalized)",
+                "CREATE INDEX power_name_normalized IF NOT EXISTS FOR (p:Power) ON (p.name_normalized)",
+                "CREATE INDEX team_name_normalized IF NOT EXISTS FOR (t:Team) ON (t.name_normalized)",
             ]
             for constraint in constraints:
                 try:
@@ -119,18 +422,196 @@ class Neo4jDataIngestion:
                         SET r.confidence = $confidence
                     """, gene_name=gene_name, power_name=power_name, confidence=confidence)
     
-    def ingest_json_file(self, file_path: str):
-        """Ingest data from JSON file"""
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-        
+    def write_rows(self, rows: Dict[str, List[Dict[str, Any]]], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """
+        Write normalized rows with UNWIND statements, one explicit transaction per batch
+
+        Args:
+            rows: Output of normalize_characters
+            batch_size (int): Maximum number of rows sent in a single transaction
+
+        Returns:
+            int: Number of rows written
+        """
+        written = 0
+        with self.driver.session() as session:
+            for kind, statement in BULK_STATEMENTS:
+                kind_rows = rows.get(kind, [])
+                for start in range(0, len(kind_rows), batch_size):
+                    batch = kind_rows[start:start + batch_size]
+                    session.execute_write(lambda tx: tx.run(statement, rows=batch).consume())
+                    written += len(batch)
+        return written
+
+    def _sync_batch(self, tx, characters: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Apply the creates and updates of one batch of characters inside a single transaction"""
+        hashes = {character["character_name"]: character_hash(character) for character in characters}
+        result = tx.run(READ_CONTENT_HASHES, names=list(hashes))
+        existing = {record["name"]: record["content_hash"] for record in result}
+
+        changed = {}
+        for character in characters:
+            name = character["character_name"]
+            if existing.get(name) != hashes[name]:
+                changed[name] = character
+        updated = [name for name in changed if name in existing]
+
+        if updated:
+            tx.run(DETACH_CHARACTERS, names=updated).consume()
+        if changed:
+            rows = normalize_characters(changed.values())
+            for kind, statement in BULK_STATEMENTS:
+                if rows[kind]:
+                    tx.run(statement, rows=rows[kind]).consume()
+
+        return {
+            "created": len(changed) - len(updated),
+            "updated": len(updated),
+            "unchanged": len(hashes) - len(changed),
+        }
+
+    def _delete_batch(self, tx, names: List[str]):
+        """Delete characters and release the CONFERS edges they declared inside a single transaction"""
+        tx.run(DETACH_CHARACTERS, names=names).consume()
+        tx.run(DELETE_CHARACTERS, names=names).consume()
+
+    def sync(self, characters: Iterable[Dict[str, Any]], batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Incrementally synchronize the graph with the given characters instead of clearing and reloading it
+        Only characters whose content hash differs from the one stored on their Character node are rewritten,
+        characters missing from the input are deleted together with nodes that are no longer referenced
+
+        Args:
+            characters: Character records, typically streamed by iter_characters
+            batch_size (int): Number of characters compared and written per transaction
+
+        Returns:
+            Dict[str, int]: Number of created, updated, unchanged and deleted characters
+        """
+        start_time = time.perf_counter()
+        stats = {"created": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        seen_names = set()
+        with self.driver.session() as session:
+            with tqdm(desc='Syncing characters', unit=' characters') as progress:
+                for batch in iter_batches(characters, batch_size):
+                    batch_stats = session.execute_write(self._sync_batch, batch)
+                    for key, value in batch_stats.items():
+                        stats[key] += value
+                    seen_names.update(character["character_name"] for character in batch)
+                    progress.update(len(batch))
+
+            stored_names = session.execute_read(lambda tx: [record["name"] for record in tx.run(READ_CHARACTER_NAMES)])
+            removed = [name for name in stored_names if name not in seen_names]
+            for batch in iter_batches(removed, batch_size):
+                session.execute_write(self._delete_batch, batch)
+            stats["deleted"] = len(removed)
+
+            if stats["updated"] or stats["deleted"]:
+                session.execute_write(lambda tx: tx.run(DELETE_ORPHANS).consume())
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Synced characters in {elapsed:.2f}s: {stats['created']} created, {stats['updated']} updated, "
+              f"{stats['unchanged']} unchanged, {stats['deleted']} deleted", flush=True)
+        return stats
+
+    def normalize_names(self, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """
+        Set name_normalized on every node missing it
+
+        Returns:
+            int: Number of nodes updated
+        """
+        with self.driver.session() as session:
+            rows = session.execute_read(lambda tx: [
+                {"id": record["id"], "name_normalized": normalize_name(record["name"] or "")}
+                for record in tx.run(READ_UNNORMALIZED_NAMES)
+            ])
+            for batch in iter_batches(rows, batch_size):
+                session.execute_write(lambda tx: tx.run(SET_NORMALIZED_NAMES, rows=batch).consume())
+        if rows:
+            print(f"Set name_normalized on {len(rows)} nodes", flush=True)
+        return len(rows)
+
+    def ingest_bulk(self, characters: Iterable[Dict[str, Any]], batch_size: int = DEFAULT_BATCH_SIZE):
+        """Normalize all characters in memory and write them with batched UNWIND statements"""
+        start_time = time.perf_counter()
+        rows = normalize_characters(characters)
+        written = self.write_rows(rows, batch_size)
+        elapsed = time.perf_counter() - start_time
+        rows_per_second = written / elapsed if elapsed > 0 else float('inf')
+        print(f"Bulk ingested {len(rows['characters'])} characters ({written} rows) in {elapsed:.2f}s, {rows_per_second:.0f} rows/s", flush=True)
+
+    def ingest_stream(self, characters: Iterable[Dict[str, Any]], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """
+        Write characters as they are read, normalizing and writing batch_size characters at a time
+        so memory stays bounded by the batch and the first write starts after the first batch is read
+
+        Returns:
+            int: Number of characters ingested
+        """
+        start_time = time.perf_counter()
+        ingested = 0
+        written = 0
+        with tqdm(desc='Ingesting characters', unit=' characters') as progress:
+            for batch in iter_batches(characters, batch_size):
+                written += self.write_rows(normalize_characters(batch), batch_size)
+                ingested += len(batch)
+                progress.update(len(batch))
+        elapsed = time.perf_counter() - start_time
+        rows_per_second = written / elapsed if elapsed > 0 else float('inf')
+        print(f"Stream ingested {ingested} characters ({written} rows) in {elapsed:.2f}s, {rows_per_second:.0f} rows/s", flush=True)
+        return ingested
+
+    def ingest_json_file(self, file_path: str, mode: str = 'stream', batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        Ingest data from a JSON or JSON Lines file
+
+        Args:
+            file_path (str): Path to the dataset
+            mode (str): 'sync' applies only the changes since the last ingestion without clearing the database,
+                'stream' reads and writes the file incrementally, 'bulk' loads it fully and writes batches,
+                'single' writes one character at a time
+            batch_size (int): Number of rows (or characters when streaming or syncing) per write transaction
+
+        Returns:
+            bool: Whether the graph changed
+        """
+        if mode == 'sync':
+            self.create_constraints()
+            stats = self.sync(iter_characters(file_path), batch_size)
+            normalized = self.normalize_names(batch_size)
+            print(f"Synced {stats['created'] + stats['updated'] + stats['unchanged']} characters into Neo4j")
+            return normalized > 0 or any(stats[key] for key in ("created", "updated", "deleted"))
+
         self.clear_database()
         self.create_constraints()
-        
-        for character in tqdm(data["characters"], desc='Ingesting characters'):
-            self.ingest_character_data(character)
-        
-        print(f"Ingested {len(data['characters'])} characters into Neo4j")
+
+        if mode == 'stream':
+            ingested = self.ingest_stream(iter_characters(file_path), batch_size)
+        else:
+            characters = list(iter_characters(file_path))
+            if mode == 'bulk':
+                self.ingest_bulk(characters, batch_size)
+            else:
+                for character in tqdm(characters, desc='Ingesting characters'):
+                    self.ingest_character_data(character)
+                self.normalize_names(batch_size)
+            ingested = len(characters)
+
+        print(f"Ingested {ingested} characters into Neo4j")
+        return True
+
+def bump_cache_version():
+    """Invalidate every cached answer by moving the Redis cache to a new key namespace"""
+    client = redis.Redis(host=os.getenv("REDIS_HOST"), port=os.getenv("REDIS_PORT"), db=0)
+    try:
+        version = client.incr(CACHE_VERSION_KEY)
+        client.publish(CACHE_INVALIDATION_CHANNEL, f"ingestion|version|{version}")
+        print(f"Cache version bumped to {version}", flush=True)
+    except Exception as e:
+        print(f"Could not bump cache version, cached answers may be stale: {e}", flush=True)
+    finally:
+        client.close()
 
 def main():
     ingestion = Neo4jDataIngestion()
@@ -151,8 +632,14 @@ def main():
 
     print('Successfully connected to Neo4j!', flush=True)
     try:
-        ingestion.ingest_json_file(os.path.join(os.path.dirname(__file__), 'marvel_dataset.json'))
+        changed = ingestion.ingest_json_file(
+            os.path.join(os.path.dirname(__file__), 'marvel_dataset.json'),
+            mode=os.getenv('INGESTION_MODE', 'sync'),
+            batch_size=int(os.getenv('INGESTION_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+        )
         print("Data ingested into Neo4j successfully!")
+        if changed:
+            bump_cache_version()
     except Exception as e:
         print(f"Error ingesting data: {e}")
         return
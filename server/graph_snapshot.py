@@ -0,0 +1,150 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+LABELS = ("Character", "Team", "Gene", "Power")
+
+# Relationship type -> (source label, target label), as created by create_knowledge_graph.py
+RELATIONSHIPS = {
+    "MEMBER_OF": ("Character", "Team"),
+    "HAS_MUTATION": ("Character", "Gene"),
+    "POSSESSES_POWER": ("Character", "Power"),
+    "CONFERS": ("Gene", "Power"),
+}
+
+def expansions(label: str) -> List[Tuple[str, str, bool]]:
+    """(relationship type, neighbor label, outgoing) for every relationship a node of the label takes part in"""
+    return [(relationship, target, True) for relationship, (source, target) in RELATIONSHIPS.items() if source == label] + \
+        [(relationship, source, False) for relationship, (source, target) in RELATIONSHIPS.items() if target == label]
+
+class Adjacency:
+    """
+    Compressed sparse row adjacency of one relationship type and direction
+    The neighbors of node i are targets[offsets[i]:offsets[i + 1]] with the matching confidences
+    """
+    def __init__(self, sources: np.ndarray, targets: np.ndarray, confidences: np.ndarray, node_count: int):
+        order = np.argsort(sources, kind="stable")
+        self.targets = targets[order]
+        self.confidences = confidences[order]
+        self.offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=self.offsets[1:])
+
+    def neighbors(self, node: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:end], self.confidences[start:end]
+
+    def degree(self, node: int) -> int:
+        return int(self.offsets[node + 1] - self.offsets[node])
+
+class GraphSnapshot:
+    """
+    Read-only in-memory copy of the knowledge graph
+    Nodes get integer ids, relationships are stored as array backed adjacency lists in both
+    directions with a float64 confidence array (NaN for a missing confidence)
+    """
+    def __init__(self, nodes: Iterable[Tuple[str, str, Optional[str]]],
+                 relationships: Iterable[Tuple[str, str, str, Optional[float]]], version=None):
+        """
+        Args:
+            nodes: (label, name, text_snippet) for every node
+            relationships: (type, source name, target name, confidence) for every relationship
+            version: Graph data version the snapshot was taken at
+        """
+        self.version = version
+        self.names: List[str] = []
+        self.ids: Dict[str, Dict[str, int]] = {label: {} for label in LABELS}
+        self.text_snippets: Dict[int, str] = {}
+        for label, name, text_snippet in nodes:
+            if label not in self.ids or name is None or name in self.ids[label]:
+                continue
+            node = len(self.names)
+            self.names.append(name)
+            self.ids[label][name] = node
+            if text_snippet is not None:
+                self.text_snippets[node] = text_snippet
+
+        edges = {relationship: ([], [], []) for relationship in RELATIONSHIPS}
+        for relationship, source, target, confidence in relationships:
+            if relationship not in RELATIONSHIPS:
+                continue
+            source_label, target_label = RELATIONSHIPS[relationship]
+            source_id = self.ids[source_label].get(source)
+            target_id = self.ids[target_label].get(target)
+            if source_id is None or target_id is None:
+                continue
+            sources, targets, confidences = edges[relationship]
+            sources.append(source_id)
+            targets.append(target_id)
+            confidences.append(np.nan if confidence is None else confidence)
+
+        node_count = len(self.names)
+        self.outgoing: Dict[str, Adjacency] = {}
+        self.incoming: Dict[str, Adjacency] = {}
+        self.relationship_count = 0
+        for relationship, (sources, targets, confidences) in edges.items():
+            sources = np.asarray(sources, dtype=np.int32)
+            targets = np.asarray(targets, dtype=np.int32)
+            confidences = np.asarray(confidences, dtype=np.float64)
+            self.outgoing[relationship] = Adjacency(sources, targets, confidences, node_count)
+            self.incoming[relationship] = Adjacency(targets, sources, confidences, node_count)
+            self.relationship_count += len(sources)
+
+    def __len__(self):
+        return len(self.names)
+
+    def node_id(self, label: str, name: str) -> Optional[int]:
+        return self.ids[label].get(name)
+
+    def _items(self, targets: np.ndarray, confidences: np.ndarray, min_confidence=None, inclusive=False) -> List[Dict]:
+        items = []
+        for target, confidence in zip(targets.tolist(), confidences.tolist()):
+            if min_confidence is not None and not (confidence >= min_confidence if inclusive else confidence > min_confidence):
+                continue
+            items.append({"name": self.names[target], "confidence": None if confidence != confidence else confidence})
+        return items
+
+    def related(self, relationship: str, node: int, incoming: bool = False, min_confidence=None, inclusive=False) -> List[Dict]:
+        """
+        Names and confidences of the nodes linked to node by relationship, with a confidence above min_confidence
+        or, when inclusive, of at least min_confidence
+        """
+        adjacency = self.incoming[relationship] if incoming else self.outgoing[relationship]
+        return self._items(*adjacency.neighbors(node), min_confidence=min_confidence, inclusive=inclusive)
+
+    def node_names(self) -> Dict[str, List[str]]:
+        return {label: list(ids) for label, ids in self.ids.items()}
+
+    def expand(self, label: str, names: Iterable[str], min_confidence=None, limit=None) -> Dict[str, Dict]:
+        """
+        Same result as the neighbor queries of graph_tools: for every existing node its text snippet and,
+        per relationship, the neighbors with a confidence of at least min_confidence, most confident first
+        """
+        expanded = {}
+        for name in names:
+            node = self.node_id(label, name)
+            if node is None:
+                continue
+            links = []
+            for relationship, neighbor_label, outgoing in expansions(label):
+                adjacency = self.outgoing[relationship] if outgoing else self.incoming[relationship]
+                targets, confidences = adjacency.neighbors(node)
+                if min_confidence is not None:
+                    keep = confidences >= min_confidence
+                    targets, confidences = targets[keep], confidences[keep]
+                # Descending by confidence, argsort puts NaN (missing confidence) last
+                order = np.argsort(-confidences, kind="stable")[:limit]
+                links.append((relationship, neighbor_label, outgoing, self._items(targets[order], confidences[order])))
+            expanded[name] = {"text_snippet": self.text_snippets.get(node), "links": links}
+        return expanded
+
+    def _sorted_sources(self, relationship: str, label: str, name: str, min_confidence, inclusive) -> List[Dict]:
+        node = self.node_id(label, name)
+        if node is None:
+            return []
+        items = self.related(relationship, node, incoming=True, min_confidence=min_confidence, inclusive=inclusive)
+        return sorted(items, key=lambda item: item["confidence"], reverse=True)
+
+    def team_members(self, team_name: str, min_confidence=0.0, inclusive=False) -> List[Dict]:
+        return self._sorted_sources("MEMBER_OF", "Team", team_name, min_confidence, inclusive)
+
+    def characters_with_power(self, power_name: str, min_confidence=0.0, inclusive=False) -> List[Dict]:
+        return self._sorted_sources("POSSESSES_POWER", "Power", power_name, min_confidence, inclusive)
@@ -1,93 +1,563 @@
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, READ_ACCESS, unit_of_work
+from neo4j.exceptions import Neo4jError
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from logger import logger
+from local_cache import LRUCache
+from graph_snapshot import GraphSnapshot, LABELS, RELATIONSHIPS, expansions
+from name_index import NameIndex, NAME_MATCH_THRESHOLD
+from typing import Tuple
+from query_guard import QueryRejected, QUERY_TIMEOUT_SECONDS
+import query_guard
+import cache_server
+import metrics
+import asyncio
+import hashlib
+import time
 import os
+import re
 import json
 
 load_dotenv()
 
+# Results of the LLM generated queries are cached under the graph data version (the cache
+# namespace bumped by ingestion), separately from answers and with their own eviction policy
+TOOL_CACHE_TTL_SECONDS = int(os.getenv("TOOL_CACHE_TTL_SECONDS", 60 * 60))
+tool_cache = LRUCache(
+    int(os.getenv("TOOL_CACHE_L1_MAX_ENTRIES", 2000)),
+    float(os.getenv("TOOL_CACHE_L1_TTL_SECONDS", 5 * 60)),
+)
+cache_server.register_local_cache("tool_results", tool_cache)
+
+# String literals and backtick quoted identifiers are kept verbatim when normalizing
+_CYPHER_LITERALS = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+_CYPHER_PUNCTUATION_SPACES = re.compile(r"\s*([(){}\[\],:;.=<>+*/-])\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_cypher(cypher_query: str) -> str:
+    """Canonical text of a Cypher query: collapsed whitespace, no spaces around punctuation, no trailing semicolon"""
+    parts = _CYPHER_LITERALS.split(cypher_query.strip().rstrip(";"))
+    for i in range(0, len(parts), 2):
+        parts[i] = _CYPHER_PUNCTUATION_SPACES.sub(r"\1", _WHITESPACE.sub(" ", parts[i]))
+    return "".join(parts).strip()
+
+def _tool_cache_key(cypher_query: str) -> str:
+    return "tool:" + hashlib.sha256(normalize_cypher(cypher_query).encode("utf-8")).hexdigest()
+
 _uri = os.getenv("NEO4J_URI")
 _user = os.getenv("NEO4J_USER")
 _password = os.getenv("NEO4J_PASSWORD")
-_driver = GraphDatabase.driver(_uri, auth=(_user, _password))
+
+# Connection pool shared by all requests, sessions are cheap and borrow pooled connections
+NEO4J_MAX_CONNECTION_POOL_SIZE = int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", 50))
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 10))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", 60 * 60))
+NEO4J_MAX_TRANSACTION_RETRY_TIME = float(os.getenv("NEO4J_MAX_TRANSACTION_RETRY_TIME", 15))
+NEO4J_WARMUP_CONNECTIONS = int(os.getenv("NEO4J_WARMUP_CONNECTIONS", 4))
+
+_driver = None
+
+def get_driver():
+    """The Neo4j driver, created on first use, connections are opened lazily by its pool"""
+    global _driver
+    if _driver is None:
+        _driver = AsyncGraphDatabase.driver(
+            _uri,
+            auth=(_user, _password),
+            max_connection_pool_size=NEO4J_MAX_CONNECTION_POOL_SIZE,
+            connection_acquisition_timeout=NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+            max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+            max_transaction_retry_time=NEO4J_MAX_TRANSACTION_RETRY_TIME,
+        )
+    return _driver
+
+async def verify_connectivity():
+    """Verify the Neo4j driver can reach the database"""
+    await get_driver().verify_connectivity()
+
+async def read_transaction(work, *args, query: str, fetch_size=None, rows=len, **kwargs):
+    """
+    Run work(tx, *args, **kwargs) in a managed read transaction
+    Read transactions can be routed to read replicas of a cluster and are retried by the driver on transient errors
+    The latency and the rows(result) rows of the returned result are recorded under the query label, rows=None counts none.
+    Rows are counted once the transaction returns, so retried attempts are not counted
+    """
+    session_config = {"fetch_size": fetch_size} if fetch_size else {}
+    with metrics.cypher_seconds.time(query):
+        async with get_driver().session(default_access_mode=READ_ACCESS, **session_config) as session:
+            result = await session.execute_read(work, *args, **kwargs)
+    if rows is not None:
+        metrics.neo4j_rows.inc(rows(result), query)
+    return result
+
+async def _fetch_all(tx, cypher_query, **parameters):
+    result = await tx.run(cypher_query, parameters)
+    return [record async for record in result]
+
+async def warm_up(connections=NEO4J_WARMUP_CONNECTIONS):
+    """Open connections concurrently so the first requests find them in the pool"""
+    start_time = time.perf_counter()
+    await asyncio.gather(*(read_transaction(_fetch_all, "RETURN 1", query="warm_up") for _ in range(connections)))
+    logger.info("Warmed up %s Neo4j connections in %.2fs", connections, time.perf_counter() - start_time)
+
+async def close():
+    """Close the Neo4j driver and its connection pool"""
+    global _driver
+    if _driver is not None:
+        await _driver.close()
+        _driver = None
+
+# Read-only in-memory copy of the graph serving the fixed query shapes, reloaded when the
+# graph data version changes. Neo4j stays the fallback and serves arbitrary Cypher
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "true").lower() == "true"
+SNAPSHOT_RETRY_SECONDS = float(os.getenv("SNAPSHOT_RETRY_SECONDS", 30))
+snapshot = None
+_snapshot_lock = asyncio.Lock()
+_snapshot_failed_at = None
+
+async def _read_graph(tx):
+    """Nodes and relationships of the graph, read in one transaction so they are consistent"""
+    result = await tx.run("""
+    MATCH (n)
+    WHERE n:Character OR n:Team OR n:Gene OR n:Power
+    RETURN [label IN labels(n) WHERE label IN $labels][0] as label, n.name as name, n.text_snippet as text_snippet
+    """, labels=list(LABELS))
+    nodes = [(record["label"], record["name"], record["text_snippet"]) async for record in result]
+    result = await tx.run("""
+    MATCH (a)-[r]->(b)
+    WHERE type(r) IN $relationships
+    RETURN type(r) as type, a.name as source, b.name as target, r.confidence as confidence
+    """, relationships=list(RELATIONSHIPS))
+    relationships = [(record["type"], record["source"], record["target"], record["confidence"]) async for record in result]
+    return nodes, relationships
+
+async def load_snapshot(request_id=None):
+    """Load the whole graph from Neo4j into a new GraphSnapshot and swap it in"""
+    global snapshot, _snapshot_failed_at
+    version = await cache_server.get_version()
+    start_time = time.perf_counter()
+    try:
+        nodes, relationships = await read_transaction(
+            _read_graph, query="snapshot", rows=lambda graph: len(graph[0]) + len(graph[1]))
+        snapshot = await asyncio.to_thread(GraphSnapshot, nodes, relationships, version)
+        _snapshot_failed_at = None
+        logger.info("Loaded graph snapshot version %s with %s nodes and %s relationships in %.2fs", version, len(snapshot),
+                    snapshot.relationship_count, time.perf_counter() - start_time, extra={"request_id": request_id})
+    except Exception as e:
+        _snapshot_failed_at = time.monotonic()
+        logger.error("Got error in loading graph snapshot, falling back to Neo4j: %s", e, extra={"request_id": request_id})
+        logger.exception(e)
+
+async def current_snapshot(request_id=None):
+    """
+    The snapshot of the current graph data version, or None when queries must go to Neo4j
+    A snapshot of another version is never served, Neo4j answers while the new one loads in the background
+    """
+    if not SNAPSHOT_ENABLED:
+        return None
+    version = await cache_server.get_version()
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    reload_graph()
+    return None
+
+# Canonical node names per label, user input is mapped to them before running the fixed queries
+names = NameIndex({})
+
+async def _load_names(version, request_id=None):
+    """Build the name index from the snapshot of the version, or from Neo4j without one, and swap it in"""
+    global names
+    if snapshot is not None and snapshot.version == version:
+        result = snapshot.node_names()
+    else:
+        result = await node_names(request_id)
+        if "error" in result:
+            return
+    start_time = time.perf_counter()
+    names = await asyncio.to_thread(NameIndex, result, version)
+    logger.info("Built name index version %s with %s names in %.2fs", version, len(names), time.perf_counter() - start_time, extra={"request_id": request_id})
+
+async def current_names(request_id=None) -> NameIndex:
+    """
+    The name index of the current graph data version. After a version change the previous index is
+    served while the new one is built in the background, only a missing index is built on the request path
+    """
+    version = await cache_server.get_version()
+    if len(names) == 0:
+        await reload_graph()
+    elif names.version != version:
+        reload_graph()
+    return names
+
+_reload_task = None
+
+async def _reload(request_id=None):
+    try:
+        version = await cache_server.get_version()
+        retry_pending = _snapshot_failed_at is not None and time.monotonic() - _snapshot_failed_at < SNAPSHOT_RETRY_SECONDS
+        if SNAPSHOT_ENABLED and (snapshot is None or snapshot.version != version) and not retry_pending:
+            async with _snapshot_lock:
+                if snapshot is None or snapshot.version != version:
+                    await load_snapshot(request_id)
+        if names.version != version or len(names) == 0:
+            await _load_names(version, request_id)
+    except Exception as e:
+        logger.error("Got error in reloading the graph: %s", e, extra={"request_id": request_id})
+
+def reload_graph(request_id=None) -> asyncio.Task:
+    """
+    Load the snapshot and the name index of the current graph data version in a background task, requests
+    keep being served meanwhile. Returns the running task, awaited by the warm up
+    """
+    global _reload_task
+    if _reload_task is None or _reload_task.done():
+        _reload_task = asyncio.create_task(_reload(request_id))
+    return _reload_task
+
+cache_server.register_version_callback(lambda version: reload_graph())
+
+async def resolve_name(label, text, request_id=None, threshold=NAME_MATCH_THRESHOLD):
+    """Canonical name of the node of the given label matching user input, case and typo tolerant, or None"""
+    return (await current_names(request_id)).resolve(label, text, threshold)
+
+# Compact description of the graph schema for the prompt, read from the graph once per data version.
+# Bookkeeping properties of the ingestion are left out
+SCHEMA_HIDDEN_PROPERTIES = ("content_hash", "declared_by")
+# After a failed read the default schema is used for the version and the read retried after SCHEMA_RETRY_SECONDS
+SCHEMA_RETRY_SECONDS = float(os.getenv("SCHEMA_RETRY_SECONDS", 30))
+_schema = None
+_schema_version = None
+_schema_failed_at = None
+_schema_lock = asyncio.Lock()
+
+async def _read_schema(tx):
+    """Properties per label and relationship type and the (source label, type, target label) patterns"""
+    result = await tx.run("CALL db.schema.nodeTypeProperties() YIELD nodeLabels, propertyName RETURN nodeLabels, propertyName")
+    node_properties = [(record["nodeLabels"], record["propertyName"]) async for record in result]
+    result = await tx.run("CALL db.schema.relTypeProperties() YIELD relType, propertyName RETURN relType, propertyName")
+    relationship_properties = [(record["relType"], record["propertyName"]) async for record in result]
+    result = await tx.run("""
+    MATCH (a)-[r]->(b)
+    RETURN DISTINCT labels(a)[0] as source, type(r) as type, labels(b)[0] as target
+    """)
+    patterns = [(record["source"], record["type"], record["target"]) async for record in result]
+    return node_properties, relationship_properties, patterns
+
+def format_schema(node_properties, relationship_properties, patterns) -> str:
+    """
+    One line per label and per relationship pattern, e.g.
+    (:Character {name, name_normalized, text_snippet})
+    (:Character)-[:MEMBER_OF {confidence}]->(:Team)
+    """
+    def properties(owners):
+        by_owner = {}
+        for owner, name in owners:
+            if name is not None and name not in SCHEMA_HIDDEN_PROPERTIES and name not in by_owner.setdefault(owner, []):
+                by_owner[owner].append(name)
+        return {owner: " {" + ", ".join(sorted(names)) + "}" if names else "" for owner, names in by_owner.items()}
+
+    labels = properties((label, name) for node_labels, name in node_properties for label in node_labels)
+    # relTypeProperties reports types as :`TYPE`
+    types = properties((relationship.strip(":`"), name) for relationship, name in relationship_properties)
+    lines = [f"(:{label}{labels[label]})" for label in sorted(labels)]
+    lines += [f"(:{source})-[:{relationship}{types.get(relationship, '')}]->(:{target})"
+              for source, relationship, target in sorted(patterns) if source and target]
+    return "\n".join(lines)
+
+def default_schema() -> str:
+    """The schema create_knowledge_graph.py ingests"""
+    node_properties = [([label], name) for label in LABELS for name in ("name", "name_normalized")] + [(["Character"], "text_snippet")]
+    patterns = [(source, relationship, target) for relationship, (source, target) in RELATIONSHIPS.items()]
+    return format_schema(node_properties, [(relationship, "confidence") for relationship in RELATIONSHIPS], patterns)
+
+async def current_schema(request_id=None) -> str:
+    """
+    The compact schema of the current graph data version, read once per version by a single caller
+    Falls back to the schema ingestion creates, kept for the version until a read retried after SCHEMA_RETRY_SECONDS succeeds
+    """
+    global _schema, _schema_version, _schema_failed_at
+
+    def cached(version):
+        retry_due = _schema_failed_at is not None and time.monotonic() - _schema_failed_at >= SCHEMA_RETRY_SECONDS
+        return _schema is not None and _schema_version == version and not retry_due
+
+    version = await cache_server.get_version()
+    if cached(version):
+        return _schema
+    async with _schema_lock:
+        if cached(version):
+            return _schema
+        try:
+            schema = format_schema(*await read_transaction(_read_schema, query="schema", rows=None))
+            _schema_failed_at = None
+            logger.info("Read graph schema version %s", version, extra={"request_id": request_id})
+        except Exception as e:
+            schema = default_schema()
+            _schema_failed_at = time.monotonic()
+            logger.error("Got error in reading graph schema, using the default schema for %ss: %s", SCHEMA_RETRY_SECONDS, e,
+                         extra={"request_id": request_id})
+        _schema, _schema_version = schema, version
+    return _schema
+
+# Budget of a single tool result, which ends up in the prompt
+TOOL_RESULT_MAX_ROWS = int(os.getenv("TOOL_RESULT_MAX_ROWS", 200))
+TOOL_RESULT_MAX_BYTES = int(os.getenv("TOOL_RESULT_MAX_BYTES", 16 * 1024))
+
+async def encode_result(result, max_rows=TOOL_RESULT_MAX_ROWS, max_bytes=TOOL_RESULT_MAX_BYTES) -> Tuple[str, int]:
+    """
+    Encode a query result as a compact table, the column names once followed by one row of values
+    per line, stopping at max_rows rows or max_bytes bytes with a truncation marker
+    Returns the table and the number of rows in it
+    """
+    header = json.dumps(await result.keys())
+    lines = [header]
+    size = len(header)
+    rows = 0
+    truncated = False
+    async for record in result:
+        line = json.dumps(list(record.data().values()), default=str)
+        if rows >= max_rows or size + 1 + len(line) > max_bytes:
+            truncated = True
+            break
+        lines.append(line)
+        size += 1 + len(line)
+        rows += 1
+
+    if not truncated and rows == 0:
+        return 'No results found.', rows
+    if truncated:
+        lines.append(f"... truncated after {rows} rows, the result exceeds the limit of {max_rows} rows or {max_bytes} bytes")
+    return "\n".join(lines), rows
+
+@unit_of_work(timeout=QUERY_TIMEOUT_SECONDS)
+async def _run_guarded(tx, cypher_query):
+    """Plan check and execution of a validated query, the server stops the transaction after QUERY_TIMEOUT_SECONDS"""
+    await query_guard.check_plan(tx, cypher_query)
+    result = await tx.run(cypher_query)
+    return await encode_result(result)
 
 class QueryInput(BaseModel):
     cypher_query: str = Field(description="cypher query formatted for Neo4j database")
 
-@tool("query_characters_database", args_schema=QueryInput, return_direct=True)
-def query_characters_database(cypher_query: str):
+# With return_direct the formatted table of a successful query is the answer, without a final LLM call
+TOOL_RETURN_DIRECT = os.getenv("TOOL_RETURN_DIRECT", "false").lower() == "true"
+
+@tool("query_characters_database", args_schema=QueryInput, return_direct=TOOL_RETURN_DIRECT)
+async def query_characters_database(cypher_query: str):
     """
     Retrieves information from Neo4j database for a given cypher query.
-    The database has 4 types of nodes: Character, Power, Gene and Team
-    All names are case sensitive. When matching with specific string use lowercase, e.g. ```WHERE toLower(p.name) = toLower("Lightning Control")```.
-    Here are the cypher commands that ingested the data into the databse and define the links between the nodes:
-    * Adding a character (superhero or villian):
-    ```MERGE (c:Character {name: $name})
-    SET c.text_snippet = $text_snippet```
-    * Character is memeber of a team:
-    ```MERGE (t:Team {name: $team_name})
-    MERGE (c:Character {name: $character_name})
-    MERGE (c)-[r:MEMBER_OF]->(t)
-    SET r.confidence = $confidence```
-    * Character has a mutation of a gene:
-    ```MERGE (g:Gene {name: $gene_name})
-    MERGE (c:Character {name: $character_name})
-    MERGE (c)-[r:HAS_MUTATION]->(g)
-    SET r.confidence = $confidence```
-    * Character posses a super power:
-    ```MERGE (p:Power {name: $power_name})
-    MERGE (c:Character {name: $character_name})
-    MERGE (c)-[r:POSSESSES_POWER]->(p)
-    SET r.confidence = $confidence```
-    * Gene confers a super power:
-    ```MERGE (g:Gene {name: $gene_name})
-    MERGE (p:Power {name: $power_name})
-    MERGE (g)-[r:CONFERS]->(p)
-    SET r.confidence = $confidence```
-
-    Returns results in json format or 'No results found.'
+    The graph schema (node labels, relationship types and their properties) is given in the system message.
+    All names are case sensitive. Every node also has an indexed name_normalized property: the name lowercased with punctuation
+    replaced by spaces, e.g. "Spider-Man" is "spider man". When matching with specific string compare it to name_normalized
+    instead of applying toLower to name, e.g. ```WHERE p.name_normalized = "lightning control"```.
+    Confidence properties are between 0 and 1.
+    Returns 'No results found.' or a table: a json list of the column names on the first line, then a json list of values per row.
+    Large results are cut and end with a line starting with '... truncated', use ORDER BY with SKIP and LIMIT to page through
+    them or return fewer properties.
+    The database is read-only. Queries estimated to be too expensive are rejected before running and slow queries are stopped,
+    errors are returned as 'Error executing query: ' followed by a json object with the reason, a message and a hint for retrying.
     """
+    cache_key = _tool_cache_key(cypher_query)
+    cached = await cache_server.get_value(cache_key, l1=tool_cache)
+    if cached is not None:
+        cache_server.stats["tool_hits"] += 1
+        return cached
+    cache_server.stats["tool_misses"] += 1
+
     try:
-        with _driver.session() as session:
-            result = session.run(cypher_query)
-            records = [record.data() for record in result]
-            if len(records) == 0:
-                return 'No results found.'
-            return json.dumps(records)
+        cypher_query = query_guard.validate(cypher_query)
+        # Records are streamed from the server, never more than one row over the budget is fetched
+        output, _ = await read_transaction(
+            _run_guarded, cypher_query, query="tool", fetch_size=TOOL_RESULT_MAX_ROWS + 1, rows=lambda encoded: encoded[1])
+    except QueryRejected as e:
+        cache_server.stats["tool_rejected"] += 1
+        logger.info("Rejected query (%s): %s", e.reason, e.message)
+        return e.tool_result()
+    except Neo4jError as e:
+        return query_guard.error_from_neo4j(e).tool_result()
     except Exception as e:
-        return f"Error executing query: {str(e)}"
+        return QueryRejected("execution_error", str(e)).tool_result()
 
-def character_neighbors(character_name, request_id=None):
-    cypher_query = """
-    MATCH (c:Character {name: $character_name})
-    OPTIONAL MATCH (c)-[r1:HAS_MUTATION]->(g:Gene)
-    OPTIONAL MATCH (c)-[r2:POSSESSES_POWER]->(p:Power)
-    OPTIONAL MATCH (c)-[r3:MEMBER_OF]->(t:Team)
-    RETURN c.name as character,
-        c.text_snippet as text_snippet,
-        collect(DISTINCT {name: g.name, confidence: r1.confidence}) as genes,
-        collect(DISTINCT {name: p.name, confidence: r2.confidence}) as powers,
-        collect(DISTINCT {name: t.name, confidence: r3.confidence}) as teams
-    """
-    
+    await cache_server.set_key_value(cache_key, output, ttl=TOOL_CACHE_TTL_SECONDS, l1=tool_cache)
+    return output
+
+# Bounds of the /graph neighborhoods, a limit applies per node and relationship type
+GRAPH_MAX_DEPTH = int(os.getenv("GRAPH_MAX_DEPTH", 3))
+GRAPH_NEIGHBOR_LIMIT = int(os.getenv("GRAPH_NEIGHBOR_LIMIT", 100))
+GRAPH_MAX_NODES = int(os.getenv("GRAPH_MAX_NODES", 1000))
+
+def _neighbors_query(label):
+    """
+    Query expanding nodes of a label: one COLLECT subquery per relationship type, so the cost is linear
+    in the node degree instead of the product of the degrees of OPTIONAL MATCH chains
+    """
+    columns = []
+    for relationship, neighbor_label, outgoing in expansions(label):
+        pattern = f"(n)-[r:{relationship}]->(m:{neighbor_label})" if outgoing else f"(n)<-[r:{relationship}]-(m:{neighbor_label})"
+        columns.append(f"""COLLECT {{
+        MATCH {pattern}
+        WHERE $min_confidence IS NULL OR r.confidence >= $min_confidence
+        RETURN {{name: m.name, confidence: r.confidence}}
+        ORDER BY r.confidence IS NULL, r.confidence DESC
+        LIMIT $limit
+    }} as {relationship}_{'out' if outgoing else 'in'}""")
+    return f"""
+    UNWIND $names as name
+    MATCH (n:{label} {{name: name}})
+    RETURN n.name as name,
+    n.text_snippet as text_snippet,
+    """ + ",\n    ".join(columns)
+
+NEIGHBOR_QUERIES = {label: _neighbors_query(label) for label in LABELS}
+
+async def expand(label, names, min_confidence=None, limit=GRAPH_NEIGHBOR_LIMIT, request_id=None):
+    """
+    Neighbors of the named nodes of a label
+
+    Returns:
+        Dict[str, Dict]: For every existing node its text_snippet and links, a list of
+            (relationship type, neighbor label, outgoing, [{name, confidence}])
+    """
+    graph = await current_snapshot(request_id)
+    if graph is not None:
+        return graph.expand(label, names, min_confidence, limit)
+
+    records = await read_transaction(_fetch_all, NEIGHBOR_QUERIES[label], query="expand", names=list(names), min_confidence=min_confidence, limit=limit)
+    return {
+        record["name"]: {
+            "text_snippet": record["text_snippet"],
+            "links": [
+                (relationship, neighbor_label, outgoing, record[f"{relationship}_{'out' if outgoing else 'in'}"])
+                for relationship, neighbor_label, outgoing in expansions(label)
+            ],
+        }
+        for record in records
+    }
+
+async def _neighborhood(character_name, root, depth, min_confidence, limit, request_id=None):
+    """Breadth first expansion from an expanded character up to depth hops, capped at GRAPH_MAX_NODES nodes"""
+    nodes = {("Character", character_name): 0}
+    relationships = {}
+    truncated = False
+    current = {"Character": root}
+    for level in range(1, depth + 1):
+        frontier = {}
+        for label, expanded in current.items():
+            for name, entry in expanded.items():
+                for relationship, neighbor_label, outgoing, items in entry["links"]:
+                    for item in items:
+                        key = (neighbor_label, item["name"])
+                        if key not in nodes:
+                            if len(nodes) >= GRAPH_MAX_NODES:
+                                truncated = True
+                                continue
+                            nodes[key] = level
+                            frontier.setdefault(neighbor_label, []).append(item["name"])
+                        source, target = (name, item["name"]) if outgoing else (item["name"], name)
+                        relationships.setdefault((relationship, source, target), item["confidence"])
+        if level == depth or not frontier:
+            break
+        current = {label: await expand(label, names, min_confidence, limit, request_id) for label, names in frontier.items()}
+    return {
+        "nodes": [{"label": label, "name": name, "depth": level} for (label, name), level in nodes.items()],
+        "relationships": [
+            {"type": relationship, "source": source, "target": target, "confidence": confidence}
+            for (relationship, source, target), confidence in relationships.items()
+        ],
+        "truncated": truncated,
+    }
+
+async def character_neighbors(character_name, request_id=None, depth=1, min_confidence=None, limit=GRAPH_NEIGHBOR_LIMIT):
+    """
+    Genes, powers and teams of a character, most confident first
+
+    Args:
+        character_name (str): Canonical character name
+        depth (int): With a depth above 1 the result also holds the neighborhood within depth hops
+        min_confidence (float): Only follow relationships with at least this confidence
+        limit (int): Maximum number of neighbors per node and relationship type
+    """
     try:
-        with _driver.session() as session:
-            result = session.run(cypher_query, character_name=character_name)
-            record = result.single()
-            
-            if not record:
-                return {"error": f"Character '{character_name}' not found"}
-            
-            return {
-                "character": record["character"],
-                "text_snippet": record["text_snippet"],
-                "genes": record["genes"],
-                "powers": record["powers"],
-                "teams": record["teams"],
-            }
+        root = await expand("Character", [character_name], min_confidence, limit, request_id)
+        if character_name not in root:
+            return {"error": f"Character '{character_name}' not found"}
+
+        links = {relationship: items for relationship, _, outgoing, items in root[character_name]["links"] if outgoing}
+        result = {
+            "character": character_name,
+            "text_snippet": root[character_name]["text_snippet"],
+            "genes": links["HAS_MUTATION"],
+            "powers": links["POSSESSES_POWER"],
+            "teams": links["MEMBER_OF"],
+        }
+        if depth > 1:
+            result["neighborhood"] = await _neighborhood(character_name, root, depth, min_confidence, limit, request_id)
+        return result
     except Exception as e:
-        logger.error(f'Got error in querying character neighbors: {e}, request_id {request_id}')
+        logger.error("Got error in querying character neighbors: %s", e, extra={"request_id": request_id})
         logger.exception(e)
         return {"error": f"Error querying character: {str(e)}"}
+
+async def node_names(request_id=None):
+    """Names of all Character, Team, Power and Gene nodes, keyed by label"""
+    graph = await current_snapshot(request_id)
+    if graph is not None:
+        return graph.node_names()
+
+    cypher_query = """
+    MATCH (n)
+    WHERE n:Character OR n:Team OR n:Power OR n:Gene
+    RETURN [label IN labels(n) WHERE label IN ['Character', 'Team', 'Power', 'Gene']][0] as label, n.name as name
+    """
+    names = {label: [] for label in LABELS}
+    try:
+        for record in await read_transaction(_fetch_all, cypher_query, query="node_names"):
+            names[record["label"]].append(record["name"])
+        return names
+    except Exception as e:
+        logger.error("Got error in querying node names: %s", e, extra={"request_id": request_id})
+        logger.exception(e)
+        return {"error": f"Error querying node names: {str(e)}"}
+
+async def team_members(team_name, min_confidence=0.0, request_id=None, inclusive=False):
+    """Members of the team with a confidence above min_confidence or, when inclusive, of at least min_confidence"""
+    graph = await current_snapshot(request_id)
+    if graph is not None:
+        return {"team": team_name, "members": graph.team_members(team_name, min_confidence, inclusive)}
+
+    cypher_query = """
+    MATCH (c:Character)-[r:MEMBER_OF]->(t:Team {name: $team_name})
+    WHERE r.confidence > $min_confidence OR ($inclusive AND r.confidence = $min_confidence)
+    RETURN c.name as name, r.confidence as confidence
+    ORDER BY r.confidence DESC
+    """
+    try:
+        records = await read_transaction(_fetch_all, cypher_query, query="team_members", team_name=team_name,
+                                         min_confidence=min_confidence, inclusive=inclusive)
+        return {"team": team_name, "members": [record.data() for record in records]}
+    except Exception as e:
+        logger.error("Got error in querying team members: %s", e, extra={"request_id": request_id})
+        logger.exception(e)
+        return {"error": f"Error querying team: {str(e)}"}
+
+async def characters_with_power(power_name, min_confidence=0.0, request_id=None, inclusive=False):
+    """Characters with the power with a confidence above min_confidence or, when inclusive, of at least min_confidence"""
+    graph = await current_snapshot(request_id)
+    if graph is not None:
+        return {"power": power_name, "characters": graph.characters_with_power(power_name, min_confidence, inclusive)}
+
+    cypher_query = """
+    MATCH (c:Character)-[r:POSSESSES_POWER]->(p:Power {name: $power_name})
+    WHERE r.confidence > $min_confidence OR ($inclusive AND r.confidence = $min_confidence)
+    RETURN c.name as name, r.confidence as confidence
+    ORDER BY r.confidence DESC
+    """
+    try:
+        records = await read_transaction(_fetch_all, cypher_query, query="characters_with_power", power_name=power_name,
+                                         min_confidence=min_confidence, inclusive=inclusive)
+        return {"power": power_name, "characters": [record.data() for record in records]}
+    except Exception as e:
+        logger.error("Got error in querying characters with power: %s", e, extra={"request_id": request_id})
+        logger.exception(e)
+        return {"error": f"Error querying power: {str(e)}"}
@@ -1,37 +1,113 @@
-
 import logging
 import sys
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import atexit
+import json
 import os
+import queue
+import random
+
+# The logger is imported before the other modules load the .env file
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", 2000))
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.1))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+# Attributes every LogRecord has, anything else was passed through extra and becomes a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_rate"}
+
+def truncate(value, max_chars=LOG_MAX_FIELD_CHARS):
+    """Cut long strings, keeping their length so truncation is visible in the logs"""
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}... [truncated {len(value) - max_chars} chars]"
+    return value
+
+def record_fields(record: logging.LogRecord):
+    """Fields passed with extra, e.g. request_id and trace_id"""
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, level, time and the extra fields of the record"""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": truncate(record.getMessage()),
+        }
+        for key, value in record_fields(record).items():
+            entry[key] = truncate(value if isinstance(value, (str, int, float, bool, type(None))) else str(value))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-def setup_logger(name='app_logger', level=logging.INFO, log_dir='logs'):
+class TextFormatter(logging.Formatter):
+    """Human readable lines with the extra fields appended as key=value"""
+    def format(self, record):
+        line = truncate(super().format(record))
+        fields = " ".join(f"{key}={truncate(str(value))}" for key, value in record_fields(record).items())
+        return f"{line} {fields}" if fields else line
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of the debug records, or of any record logged with extra={"sample_rate": rate},
+    so high volume lines cost a random draw when dropped
     """
-    Create a logger with timestamp and level formatting that saves to both console and file
+    def __init__(self, debug_sample_rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", self.debug_sample_rate if record.levelno <= logging.DEBUG else 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Enqueue records without formatting them, the message and the exception are formatted by
+    the listener thread. Records are dropped rather than blocking the event loop when the queue is full
+    """
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def setup_logger(name='app_logger', level=LOG_LEVEL, log_dir='logs'):
+    """
+    Create a logger writing to both console and file through a queue, so the calling thread
+    (the event loop) never does the formatting or the I/O
     Files are rotated daily and last 5 days are preserved
-    
+
     Args:
         name (str): Logger name
         level: Logging level (logging.INFO, logging.WARNING, logging.CRITICAL)
         log_dir (str): Directory to save log files
-    
+
     Returns:
         logging.Logger: Configured logger instance
     """
-    
+
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    
+    logger.propagate = False
+
     if logger.handlers:
         logger.handlers.clear()
-    
+
     # Create logs directory if it doesn't exist
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    
+
     # Console handler
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(level)
-    
+
     # File handler with daily rotation, keeping last 5 days
     log_file = os.path.join(log_dir, f'{name}.log')
     file_handler = TimedRotatingFileHandler(
@@ -41,28 +117,32 @@ def setup_logger(name='app_logger', level=logging.INFO, log_dir='logs'):
         backupCount=5,  # Keep 5 days of logs
         encoding='utf-8'
     )
-    file_handler.setLevel(level)
-    
-    # Create formatter
-    formatter = logging.Formatter(
-        fmt='%(asctime)s - [%(levelname)s] %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    # Add formatter to both handlers
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter(
+            fmt='%(asctime)s - [%(levelname)s] %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
     console_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
-    
-    # Add handlers to logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    
+
+    # The logger only enqueues, the listener thread formats and writes to both handlers
+    queue_handler = LazyQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
     return logger
 
 logger = setup_logger()
 
-if __name__ == "__main__":    
+if __name__ == "__main__":
     # Example usage
     logger.info("This is an info message")
+    logger.info("Message with fields", extra={"request_id": "1234"})
     logger.warning("This is a warning message")
     logger.critical("This is a critical message")
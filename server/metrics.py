@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+import bisect
+import math
+import time
+
+# Latency buckets in seconds, from in-memory lookups up to LLM calls and whole workflows
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of label values
+    Not thread safe, meant to be used from the event loop
+    """
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, *labelvalues):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in self._values.items()]
+
+class Histogram:
+    """
+    Distribution of observed values over cumulative buckets, one per combination of label values
+    Not thread safe, meant to be used from the event loop
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count per bucket (the last one is +Inf), sum and count of the observations
+        self._values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, *labelvalues):
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the seconds spent in the with block, also when it raises"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *labelvalues)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                bucket_label = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+registry: Dict[str, object] = {}
+
+def register(metric):
+    registry[metric.name] = metric
+    return metric
+
+cache_lookup_seconds = register(Histogram(
+    "marvel_cache_lookup_seconds", "Answer cache lookup latency by stage, exact key or semantic search", ("stage", "result")))
+llm_call_seconds = register(Histogram("marvel_llm_call_seconds", "Latency of each LLM call of the agent"))
+cypher_seconds = register(Histogram("marvel_cypher_seconds", "Latency of each Neo4j read transaction", ("query",)))
+workflow_seconds = register(Histogram(
+    "marvel_workflow_seconds", "Total latency of the agentic workflow", ("mode", "status")))
+agent_iterations = register(Counter("marvel_agent_iterations_total", "Agent loop iterations, one per LLM call"))
+llm_tokens = register(Counter("marvel_llm_tokens_total", "Tokens reported by the LLM", ("type",)))
+agent_stops = register(Counter(
+    "marvel_agent_stops_total", "Workflows ended by a budget or by a direct tool result", ("reason",)))
+neo4j_rows = register(Counter("marvel_neo4j_rows_total", "Rows returned by Neo4j", ("query",)))
+
+def render(counters: Dict[str, Dict[str, float]] = None) -> str:
+    """
+    Registered metrics in the Prometheus text exposition format
+    counters adds counter families from plain dicts, {metric name: {label value: count}} with the label "event"
+    """
+    lines = []
+    for metric in registry.values():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+    for name, values in (counters or {}).items():
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(f"{name}{_labels(('event',), (key,))} {_number(value)}" for key, value in values.items())
+    return "\n".join(lines) + "\n"
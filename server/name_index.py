@@ -0,0 +1,163 @@
+from dotenv import load_dotenv
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import unicodedata
+import os
+import re
+
+load_dotenv()
+
+NAME_MATCH_THRESHOLD = float(os.getenv("NAME_MATCH_THRESHOLD", 0.6))
+NAME_MATCH_CANDIDATES = 10
+# A best match scoring within NAME_MATCH_MARGIN of the runner-up is ambiguous and not resolved
+NAME_MATCH_MARGIN = float(os.getenv("NAME_MATCH_MARGIN", 0.05))
+# Shortest token matched as the prefix of a longer token, so a single letter neither picks a name nor is
+# completed by any word, e.g. "professor x" is not a prefix match of "professor xylophone"
+NAME_PREFIX_MIN_CHARS = 3
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+_LEADING_ARTICLE = re.compile(r"^the ")
+
+def normalize_name(name: str) -> str:
+    """
+    Normalized form of an entity name, stored as the indexed name_normalized property during ingestion:
+    NFKC, lowercase, punctuation replaced by spaces, single spaces, e.g. "Spider-Man" -> "spider man"
+    """
+    name = unicodedata.normalize("NFKC", name).lower()
+    return _WHITESPACE.sub(" ", _NON_WORD.sub(" ", name)).strip()
+
+def strip_article(normalized: str) -> str:
+    """Normalized name without its leading article "the", so that the input hulk matches The Hulk"""
+    return _LEADING_ARTICLE.sub("", normalized) or normalized
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def _prefix_score(query_tokens: List[str], name_tokens: List[str]) -> float:
+    """
+    0.9 when both have the same number of tokens and each token is a prefix of the other, e.g. 'prof xavier'
+    and 'professor xavier'. The shorter of two different tokens needs at least NAME_PREFIX_MIN_CHARS characters
+    """
+    if len(query_tokens) != len(name_tokens):
+        return 0.0
+    for query_token, name_token in zip(query_tokens, name_tokens):
+        if query_token == name_token:
+            continue
+        shorter, longer = sorted((query_token, name_token), key=len)
+        if not (longer.startswith(shorter) and len(shorter) >= NAME_PREFIX_MIN_CHARS):
+            return 0.0
+    return 0.9
+
+class NameIndex:
+    """
+    In-process index mapping user input to canonical node names
+    Exact matches of the normalized name, or of the name without a leading "the", are a dictionary lookup,
+    other inputs are matched through a trigram inverted index: the candidates sharing the most trigrams
+    are scored by trigram Dice coefficient, edit distance and token prefixes, all without leading "the"
+    """
+    def __init__(self, names_by_label: Dict[str, List[str]], version=None):
+        self.version = version
+        self._exact: Dict[str, Dict[str, str]] = {}
+        self._aliases: Dict[str, Dict[str, str]] = {}
+        self._normalized: Dict[str, List[str]] = {}
+        self._canonical: Dict[str, List[str]] = {}
+        self._trigrams: Dict[str, List[set]] = {}
+        self._postings: Dict[str, Dict[str, List[int]]] = {}
+        for label, names in names_by_label.items():
+            exact, aliases, normalized, canonical, grams, postings = {}, {}, [], [], [], {}
+            for name in names:
+                if not name:
+                    continue
+                key = normalize_name(name)
+                if key in exact:
+                    continue
+                exact[key] = name
+                key = strip_article(key)
+                aliases.setdefault(key, name)
+                position = len(canonical)
+                canonical.append(name)
+                normalized.append(key)
+                name_grams = trigrams(key)
+                grams.append(name_grams)
+                for gram in name_grams:
+                    postings.setdefault(gram, []).append(position)
+            self._exact[label] = exact
+            self._aliases[label] = aliases
+            self._normalized[label] = normalized
+            self._canonical[label] = canonical
+            self._trigrams[label] = grams
+            self._postings[label] = postings
+
+    def __len__(self):
+        return sum(len(names) for names in self._canonical.values())
+
+    def names(self, label: str) -> List[str]:
+        return self._canonical.get(label, [])
+
+    def match(self, label: str, text: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """Canonical names of the label closest to text with their score in [0, 1], best first"""
+        query = normalize_name(text)
+        if not query:
+            return []
+        exact = self._exact.get(label, {}).get(query)
+        if exact is None:
+            query = strip_article(query)
+            exact = self._exact.get(label, {}).get(query) or self._aliases.get(label, {}).get(query)
+        if exact is not None:
+            return [(exact, 1.0)]
+
+        query_grams = trigrams(query)
+        postings = self._postings.get(label, {})
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(postings.get(gram, ()))
+        query_tokens = query.split()
+        scored = []
+        for position, shared_count in shared.most_common(NAME_MATCH_CANDIDATES):
+            name = self._normalized[label][position]
+            dice = 2 * shared_count / (len(query_grams) + len(self._trigrams[label][position]))
+            edit = 1 - edit_distance(query, name) / max(len(query), len(name))
+            score = max(dice, edit, _prefix_score(query_tokens, name.split()))
+            scored.append((self._canonical[label][position], score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:limit]
+
+    def mentions(self, text: str, max_tokens: int = 6) -> set:
+        """(label, canonical name) of every node whose normalized name appears as whole words in text"""
+        tokens = normalize_name(text).split()
+        found = set()
+        for start in range(len(tokens)):
+            for end in range(start + 1, min(start + max_tokens, len(tokens)) + 1):
+                phrase = " ".join(tokens[start:end])
+                for label, exact in self._exact.items():
+                    name = exact.get(phrase) or self._aliases[label].get(phrase)
+                    if name is not None:
+                        found.add((label, name))
+        return found
+
+    def resolve(self, label: str, text: str, threshold: float = NAME_MATCH_THRESHOLD,
+                margin: float = NAME_MATCH_MARGIN) -> Optional[str]:
+        """
+        Canonical name of the label best matching text, or None when nothing scores above threshold
+        or when the runner-up scores within margin of the best match
+        """
+        matches = self.match(label, text, limit=2)
+        if not matches or matches[0][1] < threshold:
+            return None
+        if len(matches) > 1 and matches[0][1] < 1.0 and matches[0][1] - matches[1][1] < margin:
+            return None
+        return matches[0][0]
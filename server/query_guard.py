@@ -0,0 +1,124 @@
+from neo4j.exceptions import Neo4jError
+from dotenv import load_dotenv
+from typing import Dict, Optional, Tuple
+import json
+import os
+import re
+
+load_dotenv()
+
+# LLM generated Cypher is validated statically, then planned with EXPLAIN and rejected when the
+# planner estimates more rows than the budget, before it runs in a read transaction with a timeout
+QUERY_MAX_ESTIMATED_ROWS = float(os.getenv("QUERY_MAX_ESTIMATED_ROWS", 1_000_000))
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", 10))
+
+# String literals, backtick quoted identifiers and comments are blanked before looking for clauses
+_LITERALS_AND_COMMENTS = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|//[^\n]*|/\*.*?\*/""", re.DOTALL)
+# Obvious writes only, a keyword followed by what its clause needs, so names like start, end or set are not
+# taken for clauses. The query type planned by EXPLAIN in check_plan is what rejects every other write
+_WRITE_CLAUSES = re.compile(
+    r"(?<![.:$\w])(CREATE|MERGE|FOREACH)\s*\(|(?<![.:$\w])(DETACH\s+DELETE|LOAD\s+CSV|IN\s+TRANSACTIONS)(?!\w)|"
+    r"(?<![.:$\w])(SET)\s+\w+\s*(?:\.\s*\w+\s*=|:\s*\w|\+?=)|(?<![.:$\w])(REMOVE)\s+\w+\s*[.:]\s*\w|"
+    r"(?<![.:$\w])(CREATE|DROP|ALTER)\s+(?:OR\s+REPLACE\s+)?(?:INDEX|CONSTRAINT|DATABASE|ALIAS|USER|ROLE)(?!\w)",
+    re.IGNORECASE,
+)
+_PREFIXES = re.compile(r"^\s*(EXPLAIN|PROFILE)(?!\w)", re.IGNORECASE)
+_PROCEDURE_CALLS = re.compile(r"(?<![.:$\w])CALL\s+([A-Za-z_][\w.]*)", re.IGNORECASE)
+_READ_ONLY_HINT = "Use only MATCH, OPTIONAL MATCH, WITH, WHERE, UNWIND, CALL subqueries and RETURN."
+ALLOWED_PROCEDURES = ("db.labels", "db.relationshipTypes", "db.propertyKeys", "db.schema.visualization", "db.schema.nodeTypeProperties",
+                      "db.schema.relTypeProperties")
+
+class QueryRejected(Exception):
+    """A query refused by the guard or failed in Neo4j, reported to the LLM so it can retry with a different query"""
+    def __init__(self, reason: str, message: str, hint: Optional[str] = None):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.hint = hint
+
+    def to_dict(self) -> Dict[str, str]:
+        error = {"reason": self.reason, "message": self.message}
+        if self.hint:
+            error["hint"] = self.hint
+        return error
+
+    def tool_result(self) -> str:
+        return "Error executing query: " + json.dumps(self.to_dict())
+
+def validate(cypher_query: str) -> str:
+    """
+    Statically check that a query is a single statement without obvious writes
+
+    Returns:
+        str: The query without its trailing semicolon
+
+    Raises:
+        QueryRejected: For obvious writes and schema commands, procedures outside
+            ALLOWED_PROCEDURES, several statements, EXPLAIN and PROFILE
+    """
+    cypher_query = cypher_query.strip().rstrip(";").strip()
+    code = _LITERALS_AND_COMMENTS.sub(" ", cypher_query)
+    if not code.strip():
+        raise QueryRejected("empty_query", "The query is empty.")
+    if ";" in code:
+        raise QueryRejected("multiple_statements", "Only a single statement is allowed.", "Send one query per tool call.")
+    prefix = _PREFIXES.match(code)
+    if prefix:
+        raise QueryRejected("not_allowed", f"{prefix.group(1).upper()} is not allowed.", "Send the query without the prefix.")
+    write = _WRITE_CLAUSES.search(code)
+    if write:
+        clause = " ".join(next(group for group in write.groups() if group).upper().split())
+        raise QueryRejected("read_only", f"The database is read-only, {clause} is not allowed.", _READ_ONLY_HINT)
+    for procedure in _PROCEDURE_CALLS.findall(code):
+        if procedure not in ALLOWED_PROCEDURES:
+            raise QueryRejected("not_allowed", f"Procedure {procedure} is not allowed.",
+                                f"Allowed procedures: {', '.join(ALLOWED_PROCEDURES)}.")
+    return cypher_query
+
+def _costliest_operator(plan: Dict) -> Tuple[float, str]:
+    """Highest estimated row count among the operators of a plan and the operator producing it"""
+    rows = float(plan.get("args", {}).get("EstimatedRows", 0.0))
+    worst = (rows, plan.get("operatorType", "unknown").split("@")[0])
+    for child in plan.get("children", []):
+        worst = max(worst, _costliest_operator(child))
+    return worst
+
+async def check_plan(tx, cypher_query: str, max_estimated_rows: float = QUERY_MAX_ESTIMATED_ROWS):
+    """
+    Plan the query with EXPLAIN, which does not execute it, and reject it when it is not a read query
+    or when an operator is estimated to produce more than max_estimated_rows rows
+
+    Raises:
+        QueryRejected: When the query does not compile, writes or is too expensive
+    """
+    try:
+        result = await tx.run("EXPLAIN " + cypher_query)
+        summary = await result.consume()
+    except Neo4jError as e:
+        raise error_from_neo4j(e)
+    # Query type of the plan: r read only, rw read and write, w write only, s schema write
+    if summary.query_type != "r":
+        raise QueryRejected("read_only", "The database is read-only, the query writes to it.", _READ_ONLY_HINT)
+    if not summary.plan:
+        return
+    rows, operator = _costliest_operator(summary.plan)
+    if rows > max_estimated_rows:
+        raise QueryRejected(
+            "too_expensive",
+            f"The query plan is estimated to produce {rows:.0f} rows in {operator}, over the limit of {max_estimated_rows:.0f}.",
+            "Start from a specific node, e.g. MATCH (c:Character {name: ...}), connect every pattern instead of "
+            "matching unrelated patterns, and filter with WHERE before expanding relationships.",
+        )
+
+def error_from_neo4j(error: Neo4jError) -> QueryRejected:
+    """Structured error for a failure reported by Neo4j"""
+    code = error.code or ""
+    message = error.message or str(error)
+    if "TimedOut" in code or "Terminated" in code:
+        return QueryRejected("timeout", f"The query was stopped after {QUERY_TIMEOUT_SECONDS:.0f} seconds.",
+                             "Use a cheaper query: start from a specific node and add LIMIT.")
+    if "SyntaxError" in code or "SemanticError" in code or "ArgumentError" in code or "TypeError" in code:
+        return QueryRejected("invalid_query", message, "Fix the query according to the error message.")
+    if "AccessMode" in code or "Forbidden" in code:
+        return QueryRejected("read_only", message, "The database is read-only, do not modify it.")
+    return QueryRejected("execution_error", message)
@@ -0,0 +1,219 @@
+from dotenv import load_dotenv
+from logger import logger
+from typing import Dict, List, Optional, Tuple
+import graph_tools
+import cache_server
+import os
+import re
+
+load_dotenv()
+
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+# Entities not spelled exactly like a node name are resolved fuzzily, stricter than for /graph
+# since a wrong match answers a different question
+FAST_PATH_NAME_THRESHOLD = float(os.getenv("FAST_PATH_NAME_THRESHOLD", 0.8))
+
+# Labels in the order they win when the same text names nodes of several labels
+LABELS = ["Character", "Team", "Power", "Gene"]
+
+_POSSESSIVE = re.compile(r"['’]s\b")
+# Punctuation but the comparison operators > and >=
+_NON_WORD = re.compile(r"[^\w\s.>=]|(?<!>)=")
+_NON_DECIMAL_DOT = re.compile(r"\.(?!\d)")
+_COMPARISON = re.compile(r"\s*(>=?)\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase, drop possessives and punctuation but keep decimal numbers such as 0.5 and the comparison
+    operators > and >= as words, e.g. "confidence>=0.5" -> "confidence >= 0.5"
+    """
+    text = _POSSESSIVE.sub("", text.lower().replace("≥", ">="))
+    text = _COMPARISON.sub(r" \1 ", _NON_DECIMAL_DOT.sub(" ", _NON_WORD.sub(" ", text)))
+    return _WHITESPACE.sub(" ", text).strip()
+
+_POWERS = r"(?:super ?powers?|powers?|abilities|ability)"
+_GENES = r"(?:gene mutations?|genes?|mutations?|mutated genes?)"
+_TEAMS = r"(?:teams?|affiliations?)"
+_LIST = r"(?:(?:what|which) (?:are|is)|list|show(?: me)?|give me|tell me|return|name)(?: all)?(?: of)?(?: the)?"
+# The comparison is inclusive for "at least", "or equal to" and >=, strict otherwise
+_CONFIDENCE = (r"(?: with(?: a)? confidence(?: score)? (?P<comparison>(?:higher|higer|greater|more|bigger|larger) than"
+               r"(?: or equal to)?|above|over|(?:of )?at least|not less than|>=?) (?P<confidence>\d*\.?\d+))?")
+_INCLUSIVE = re.compile(r"least|equal|not less|>=")
+
+# Question shapes answered without the LLM, matched after entity names are replaced by placeholders
+TEMPLATES = [
+    ("powers", re.compile(rf"^{_LIST} {_POWERS} of __character__$")),
+    ("powers", re.compile(rf"^{_LIST} __character__ {_POWERS}$")),
+    ("powers", re.compile(rf"^(?:what|which) {_POWERS} (?:does|do) __character__ (?:have|possess)$")),
+    ("powers", re.compile(rf"^__character__ {_POWERS}$")),
+    ("genes", re.compile(rf"^{_LIST} {_GENES} of __character__$")),
+    ("genes", re.compile(rf"^{_LIST} __character__ {_GENES}$")),
+    ("genes", re.compile(rf"^(?:what|which) {_GENES} (?:does|do) __character__ (?:have|carry|possess)$")),
+    ("genes", re.compile(rf"^__character__ {_GENES}$")),
+    ("teams", re.compile(rf"^{_LIST} {_TEAMS} of __character__$")),
+    ("teams", re.compile(rf"^{_LIST} __character__ {_TEAMS}$")),
+    ("teams", re.compile(r"^(?:what|which) teams? (?:is|does) __character__ (?:in|on|part of|a member of|belong to|member of)$")),
+    ("teams", re.compile(rf"^__character__ {_TEAMS}$")),
+    ("members", re.compile(rf"^(?:(?:(?:who|what) (?:are|is)|list|show(?: me)?|give me|tell me|return|name)(?: all)?(?: of)?(?: the)? )?"
+                           rf"(?:names?(?: of)? )?(?:the )?(?:team )?members (?:of|in)(?: the)?(?: team)? __team__(?: team)?{_CONFIDENCE}$")),
+    ("members", re.compile(rf"^(?:{_LIST} )?__team__(?: team)? members{_CONFIDENCE}$")),
+    ("members", re.compile(rf"^(?:who (?:is|are) in|who belongs? to)(?: the)?(?: team)? __team__(?: team)?{_CONFIDENCE}$")),
+    ("power_holders", re.compile(rf"^(?:who|which characters?|which heroes|which mutants) (?:has|have|possess(?:es)?)"
+                                 rf"(?: the)?(?: power(?: of)?)? __power__(?: power)?{_CONFIDENCE}$")),
+    ("profile", re.compile(r"^(?:who is|who s|who was|tell me about|what do you know about) __character__$")),
+]
+
+# Same shapes with free text in place of the placeholders, for names that did not match exactly
+_PLACEHOLDERS = re.compile(r"__(character|team|power)__")
+FUZZY_TEMPLATES = [
+    (intent, re.compile(_PLACEHOLDERS.sub(lambda match: rf"(?P<{match.group(1)}>[\w ]+?)", template.pattern)))
+    for intent, template in TEMPLATES
+]
+_ENUMERATION = re.compile(r"\b(?:and|or)\b")
+
+_names: Dict[str, Tuple[str, str]] = {}
+_max_name_words = 0
+# Name index the router index was built from
+_source_index = None
+
+async def load_index(request_id=None):
+    """Load the names of all graph entities into the router index, unless it holds the current name index already"""
+    global _names, _max_name_words, _source_index
+    index = await graph_tools.current_names(request_id)
+    if index is _source_index:
+        return
+    _source_index = index
+    names = {}
+    for label in reversed(LABELS):
+        for name in index.names(label):
+            names[normalize_text(name)] = (label, name)
+    _names = names
+    _max_name_words = max((len(key.split()) for key in names), default=0)
+    if not names:
+        logger.error("Fast path router disabled until the next reload, no names loaded", extra={"request_id": request_id})
+        return
+    logger.info("Loaded %s names into fast path router", len(names), extra={"request_id": request_id})
+
+def extract_entities(text: str) -> Tuple[str, Dict[str, List[str]]]:
+    """
+    Replace the longest entity names found in the normalized text by __label__ placeholders
+
+    Returns:
+        Tuple[str, Dict[str, List[str]]]: Text with placeholders and the canonical names found per label
+    """
+    words = text.split()
+    output, entities = [], {}
+    i = 0
+    while i < len(words):
+        for size in range(min(_max_name_words, len(words) - i), 0, -1):
+            match = _names.get(" ".join(words[i:i + size]))
+            if match:
+                label, name = match
+                output.append(f"__{label.lower()}__")
+                entities.setdefault(label, []).append(name)
+                i += size
+                break
+        else:
+            output.append(words[i])
+            i += 1
+    return " ".join(output), entities
+
+def _confidence(groups: Dict[str, Optional[str]]) -> Tuple[float, bool]:
+    """The confidence floor of the question and whether a confidence equal to it is included"""
+    if not groups.get("confidence"):
+        return 0.0, False
+    return float(groups["confidence"]), bool(_INCLUSIVE.search(groups["comparison"]))
+
+def match_intent(question: str, index=None) -> Optional[Tuple[str, Dict[str, str], float, bool]]:
+    """
+    Return the intent, its entities, the confidence floor and whether the floor is inclusive for a known
+    question shape, or None
+    Entity names are first matched exactly, then through the fuzzy name index when one is given
+    """
+    normalized = normalize_text(question)
+    text, entities = extract_entities(normalized)
+    if any(len(names) > 1 for names in entities.values()):
+        return None
+    for intent, template in TEMPLATES:
+        match = template.match(text)
+        if match:
+            return (intent, {label: names[0] for label, names in entities.items()}, *_confidence(match.groupdict()))
+    if index is None:
+        return None
+    for intent, template in FUZZY_TEMPLATES:
+        match = template.match(normalized)
+        if not match:
+            continue
+        groups = match.groupdict()
+        label = next(label for label in ("character", "team", "power") if groups.get(label))
+        if _ENUMERATION.search(groups[label]):
+            return None
+        name = index.resolve(label.capitalize(), groups[label], FAST_PATH_NAME_THRESHOLD)
+        if name is None:
+            return None
+        return (intent, {label.capitalize(): name}, *_confidence(groups))
+    return None
+
+def _bullets(items, empty):
+    items = [item for item in items if item.get("name") is not None]
+    if not items:
+        return empty
+    items = sorted(items, key=lambda item: item.get("confidence") or 0.0, reverse=True)
+    return "\n".join(f"• {item['name']} (confidence: {item['confidence']:.2f})" for item in items)
+
+async def _answer_character(intent, character, request_id):
+    result = await graph_tools.character_neighbors(character, request_id)
+    if "error" in result:
+        return None
+    if intent == "profile":
+        return (f"{result['text_snippet']}\n\n"
+                f"Teams:\n{_bullets(result['teams'], 'None found')}\n\n"
+                f"Powers:\n{_bullets(result['powers'], 'None found')}\n\n"
+                f"Gene mutations:\n{_bullets(result['genes'], 'None found')}")
+    title, key = {
+        "powers": ("powers", "powers"),
+        "genes": ("gene mutations", "genes"),
+        "teams": ("teams", "teams"),
+    }[intent]
+    return f"{character}'s {title}:\n" + _bullets(result[key], f"No {title} of {character} were found in the database.")
+
+def _confidence_clause(min_confidence, inclusive):
+    if inclusive:
+        return f" with confidence of at least {min_confidence}"
+    return f" with confidence higher than {min_confidence}" if min_confidence else ""
+
+async def route(question: str, request_id=None) -> Optional[str]:
+    """
+    Answer known question shapes with parameterized queries and local formatting
+
+    Returns:
+        Optional[str]: The answer, or None when the question must go through the agentic workflow
+    """
+    if not FAST_PATH_ENABLED:
+        return None
+    await load_index(request_id)
+    match = match_intent(question, await graph_tools.current_names(request_id))
+    if match is None:
+        return None
+    intent, entities, min_confidence, inclusive = match
+
+    if intent in ("powers", "genes", "teams", "profile"):
+        answer = await _answer_character(intent, entities["Character"], request_id)
+    elif intent == "members":
+        result = await graph_tools.team_members(entities["Team"], min_confidence, request_id, inclusive)
+        answer = None if "error" in result else (
+            f"Members of {result['team']}{_confidence_clause(min_confidence, inclusive)}:\n"
+            + _bullets(result["members"], "No members found in the database.")
+        )
+    else:
+        result = await graph_tools.characters_with_power(entities["Power"], min_confidence, request_id, inclusive)
+        answer = None if "error" in result else (
+            f"Characters with the power {result['power']}{_confidence_clause(min_confidence, inclusive)}:\n"
+            + _bullets(result["characters"], "No characters found in the database.")
+        )
+
+    if answer is not None:
+        cache_server.stats["fast_path_hits"] += 1
+        logger.info("Answered by fast path router with intent %s", intent, extra={"request_id": request_id})
+    return answer
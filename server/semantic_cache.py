@@ -0,0 +1,457 @@
+from dotenv import load_dotenv
+from logger import logger
+from cache_server import redis_client, set_key_value, get_value, get_values, get_version, namespaced, stats, CACHE_TTL_SECONDS
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import numpy as np
+import graph_tools
+import metrics
+import asyncio
+import unicodedata
+import hashlib
+import math
+import time
+import os
+import re
+
+load_dotenv()
+
+VECTORS_KEY = "semantic_vectors"
+RECENT_EMBEDDINGS_SIZE = 1024
+
+_PUNCTUATION = re.compile(r"[^\w\s.]")
+_NON_DECIMAL_DOT = re.compile(r"(?<!\d)\.|\.(?!\d)")
+_WHITESPACE = re.compile(r"\s+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+def normalize_question(question: str) -> str:
+    """
+    Canonical form of a question used as cache key: NFKC, lowercase, no punctuation but decimal numbers
+    such as 0.5 kept, single spaces
+    """
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = _NON_DECIMAL_DOT.sub(" ", _PUNCTUATION.sub(" ", question))
+    return _WHITESPACE.sub(" ", question).strip()
+
+def _same_details(normalized: str, other: str) -> bool:
+    """
+    Whether two normalized questions mention the same numbers and graph entities, similar embeddings
+    barely tell "confidence higher than 0.5" from "higher than 0.9" or one character from another
+    """
+    if sorted(_NUMBER.findall(normalized)) != sorted(_NUMBER.findall(other)):
+        return False
+    return graph_tools.names.mentions(normalized) == graph_tools.names.mentions(other)
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class HashingEmbedder:
+    """
+    Deterministic local embedder, hashes words and character trigrams into a fixed size vector
+    Needs no network access, intended for tests and offline runs
+    """
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> List[Tuple[str, float]]:
+        features = []
+        for word in text.split():
+            features.append((f"w:{word}", 1.0))
+            padded = f"#{word}#"
+            features.extend((f"c:{padded[i:i + 3]}", 0.5) for i in range(len(padded) - 2))
+        return features
+
+    async def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature, weight in self._features(text):
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            sign = 1.0 if digest & 1 else -1.0
+            vector[(digest >> 1) % self.dimensions] += sign * weight
+        return _unit(vector)
+
+class OpenAIEmbedder:
+    """Embedder backed by the OpenAI embeddings API"""
+    def __init__(self, model: str, dimensions: int = 256):
+        from langchain_openai import OpenAIEmbeddings
+        self.dimensions = dimensions
+        self._embeddings = OpenAIEmbeddings(
+            model=model,
+            dimensions=dimensions,
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+        )
+
+    async def embed(self, text: str) -> np.ndarray:
+        return _unit(await self._embeddings.aembed_query(text))
+
+class VectorIndex:
+    """
+    In-memory cosine similarity index over unit vectors
+    Searches exhaustively while small, once it reaches ivf_threshold entries it is partitioned
+    with k-means (IVF) and a query only scans the nprobe closest partitions. The partitions are
+    retrained in a worker thread every time the index doubles in size
+    Entries older than ttl_seconds are never returned, they are evicted at most every evict_seconds and when the
+    index grows over max_size, which also evicts the oldest entries down to 90% of max_size. Evicted rows are left
+    empty and reclaimed once they are half of the rows
+    """
+    def __init__(self, dimensions: int, ttl_seconds: Optional[float] = None, max_size: Optional[int] = None,
+                 evict_seconds: float = 60, ivf_threshold: int = 20000, nprobe: int = 8):
+        self.dimensions = dimensions
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.evict_seconds = evict_seconds
+        self._evicted_at = time.time()
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._vectors = np.empty((1024, dimensions), dtype=np.float32)
+        # Time each row was added, -inf for evicted rows so they fail every age check
+        self._added = np.empty(1024, dtype=np.float64)
+        self._keys: List[Optional[str]] = []
+        self._rows = {}
+        self._centroids: Optional[np.ndarray] = None
+        self._partitions: List[List[int]] = []
+        self._trained_size = 0
+        self._training = False
+        self._rng = np.random.default_rng(0)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key: str):
+        return key in self._rows
+
+    def add(self, key: str, vector: np.ndarray, added_at: Optional[float] = None) -> List[str]:
+        """Add or replace the vector of a key, returns the keys evicted to stay within the age and size bounds"""
+        vector = _unit(vector)
+        added_at = time.time() if added_at is None else added_at
+        row = self._rows.get(key)
+        if row is not None:
+            self._vectors[row] = vector
+            self._added[row] = added_at
+            return self._evict_due()
+        row = len(self._keys)
+        if row == len(self._vectors):
+            grown = np.empty((2 * len(self._vectors), self.dimensions), dtype=np.float32)
+            grown[:row] = self._vectors
+            self._vectors = grown
+            self._added = np.resize(self._added, 2 * len(self._added))
+        self._vectors[row] = vector
+        self._added[row] = added_at
+        self._keys.append(key)
+        self._rows[key] = row
+        if self._centroids is not None:
+            self._partitions[int(np.argmax(self._centroids @ vector))].append(row)
+        return self._evict_due()
+
+    def _evict_due(self) -> List[str]:
+        if (self.max_size is not None and len(self._rows) > self.max_size) or time.time() - self._evicted_at >= self.evict_seconds:
+            return self.evict()
+        return []
+
+    def _cutoff(self, now: Optional[float] = None) -> float:
+        if self.ttl_seconds is None:
+            return -np.inf
+        return (time.time() if now is None else now) - self.ttl_seconds
+
+    def evict(self, now: Optional[float] = None) -> List[str]:
+        """
+        Remove the entries older than ttl_seconds and, over max_size, the oldest ones down to 90% of max_size
+        Returns the keys of the removed entries
+        """
+        self._evicted_at = time.time()
+        added = self._added[:len(self._keys)]
+        expired = added < self._cutoff(now)
+        rows = np.nonzero(expired & np.isfinite(added))[0]
+        live = len(self._rows) - len(rows)
+        if self.max_size is not None and live > self.max_size:
+            excess = live - int(0.9 * self.max_size)
+            remaining = np.where(expired | ~np.isfinite(added), np.inf, added)
+            rows = np.concatenate([rows, np.argpartition(remaining, excess - 1)[:excess]])
+        evicted = []
+        for row in rows.tolist():
+            evicted.append(self._keys[row])
+            del self._rows[self._keys[row]]
+            self._keys[row] = None
+            self._added[row] = -np.inf
+        if evicted and 2 * len(self._rows) < len(self._keys) and not self._training:
+            self._compact()
+        return evicted
+
+    def _compact(self):
+        """Move the live rows to the front, keeping their partitions"""
+        live = np.nonzero(np.isfinite(self._added[:len(self._keys)]))[0]
+        moved = np.full(len(self._keys), -1, dtype=np.int64)
+        moved[live] = np.arange(len(live))
+        self._vectors[:len(live)] = self._vectors[live]
+        self._added[:len(live)] = self._added[live]
+        self._keys = [self._keys[row] for row in live.tolist()]
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._partitions = [[int(moved[row]) for row in partition if moved[row] >= 0] for partition in self._partitions]
+        self._trained_size = min(self._trained_size, len(self._keys))
+
+    def needs_training(self) -> bool:
+        return not self._training and len(self._keys) >= self.ivf_threshold and len(self._keys) >= 2 * self._trained_size
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), chunk_size)
+        ])
+
+    async def train(self):
+        """
+        Partition the index with k-means in a worker thread while searches and additions continue. The thread reads
+        the rows present at the start, growing the index allocates a new array and leaves them in place, and rows are
+        not compacted during the training. Vectors added during the training are assigned to the new partitions when
+        swapping them in
+        """
+        if self._training:
+            return
+        self._training = True
+        try:
+            size = len(self._keys)
+            centroids, partitions = await asyncio.to_thread(self._train, self._vectors[:size])
+            for row in range(size, len(self._keys)):
+                partitions[int(np.argmax(centroids @ self._vectors[row]))].append(row)
+            self._centroids, self._partitions, self._trained_size = centroids, partitions, size
+            logger.info("Trained semantic cache index with %s partitions over %s entries", len(partitions), size)
+        finally:
+            self._training = False
+
+    def _train(self, vectors: np.ndarray, iterations: int = 10) -> Tuple[np.ndarray, List[List[int]]]:
+        size = len(vectors)
+        partitions_count = max(1, int(math.sqrt(size)))
+        sample = vectors[self._rng.choice(size, min(size, 64 * partitions_count), replace=False)]
+        centroids = sample[:partitions_count].copy()
+        for _ in range(iterations):
+            assignment = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assignment = self._assign(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(partitions_count + 1))
+        return centroids, [order[bounds[i]:bounds[i + 1]].tolist() for i in range(partitions_count)]
+
+    def search(self, vector: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """Keys of the k most similar entries not older than ttl_seconds with their cosine similarity, best first"""
+        if not self._rows:
+            return []
+        vector = _unit(vector)
+        if self._centroids is None:
+            rows = np.arange(len(self._keys))
+        else:
+            nprobe = min(self.nprobe, len(self._centroids))
+            probes = np.argpartition(-(self._centroids @ vector), nprobe - 1)[:nprobe]
+            rows = np.fromiter((row for probe in probes for row in self._partitions[probe]), dtype=np.int64)
+        rows = rows[self._added[rows] >= self._cutoff()]
+        if len(rows) == 0:
+            return []
+        scores = self._vectors[rows] @ vector
+        k = min(k, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self._keys[rows[i]], float(scores[i])) for i in best.tolist()]
+
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", 256))
+
+def create_embedder():
+    if os.getenv("SEMANTIC_CACHE_EMBEDDER", "openai") == "hashing":
+        return HashingEmbedder(SEMANTIC_CACHE_DIMENSIONS)
+    return OpenAIEmbedder(os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "text-embedding-3-small"), SEMANTIC_CACHE_DIMENSIONS)
+
+similarity_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+# Entries in the similarity index, the oldest are evicted beyond it
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 100000))
+# Similar questions checked for a live answer with the same numbers and entities, best first
+SEMANTIC_CACHE_CANDIDATES = int(os.getenv("SEMANTIC_CACHE_CANDIDATES", 5))
+
+def create_index() -> VectorIndex:
+    """Similarity index whose entries expire with the cached answers"""
+    return VectorIndex(SEMANTIC_CACHE_DIMENSIONS, ttl_seconds=CACHE_TTL_SECONDS, max_size=SEMANTIC_CACHE_MAX_ENTRIES)
+
+# Created on first use, the OpenAI embedder imports langchain_openai which takes about a second
+embedder = None
+index = create_index()
+
+def get_embedder():
+    """The configured embedder, created on first use"""
+    global embedder
+    if embedder is None:
+        embedder = create_embedder()
+    return embedder
+
+_index_version = None
+
+# Embeddings of recently looked up questions, so storing the answer of a miss does not embed it again
+_recent_embeddings = OrderedDict()
+
+async def _embed(normalized: str) -> np.ndarray:
+    vector = _recent_embeddings.get(normalized)
+    if vector is None:
+        vector = await get_embedder().embed(normalized)
+        _recent_embeddings[normalized] = vector
+        if len(_recent_embeddings) > RECENT_EMBEDDINGS_SIZE:
+            _recent_embeddings.popitem(last=False)
+    return vector
+
+def _answer_key(normalized: str) -> str:
+    return f"answer:{normalized}"
+
+def _encode_entry(vector: np.ndarray, added_at: float) -> bytes:
+    """Value of a question in the Redis vectors hash: the time it was added as float64, then the float32 vector"""
+    return np.float64(added_at).tobytes() + np.asarray(vector, dtype=np.float32).tobytes()
+
+def _decode_entry(encoded: bytes, dimensions: int) -> Optional[Tuple[np.ndarray, float]]:
+    """The vector and the time it was added, None for a value of another size"""
+    if len(encoded) != 8 + 4 * dimensions:
+        return None
+    return np.frombuffer(encoded, dtype=np.float32, offset=8), float(np.frombuffer(encoded, dtype=np.float64, count=1)[0])
+
+# References to the index loading and training tasks, so they are not garbage collected
+_background_tasks = set()
+
+def _in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def _sync_index_version(version: int) -> bool:
+    """Replace the in-memory index when the cache namespace moved to a new version, returns whether it was replaced"""
+    global index, _index_version
+    if version == _index_version:
+        return False
+    if _index_version is not None:
+        logger.info("Cache version changed from %s to %s, reloading semantic cache index", _index_version, version)
+    index = create_index()
+    _index_version = version
+    return True
+
+async def _sync_index(version: int):
+    """Switch to the index of the version, loaded in the background from the entries of all replicas in Redis"""
+    if _sync_index_version(version):
+        _in_background(_load_vectors(index, version))
+
+async def _load_vectors(vector_index: VectorIndex, version: int):
+    """Add the entries of the Redis hash to the index and delete the expired, evicted and unreadable ones from the hash"""
+    vectors_key = f"cache:v{version}:{VECTORS_KEY}"
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    try:
+        removed = []
+        async for key, encoded in redis_client.hscan_iter(vectors_key, count=1000):
+            key = key.decode("utf-8")
+            entry = _decode_entry(encoded, vector_index.dimensions)
+            if entry is None or entry[1] < cutoff:
+                removed.append(key)
+            else:
+                removed.extend(vector_index.add(key, *entry))
+        # An entry evicted by the size bound may have been re-added by a later field of the scan
+        removed = [key for key in removed if key not in vector_index]
+        if removed:
+            await redis_client.hdel(vectors_key, *removed)
+        logger.info("Loaded %s entries into semantic cache index version %s, removed %s", len(vector_index), version, len(removed))
+        if vector_index.needs_training():
+            await vector_index.train()
+    except Exception as e:
+        logger.error("Error loading semantic cache index: %s", e)
+
+async def load_index():
+    """Load the question embeddings stored in Redis for the current cache version into the in-memory index"""
+    version = await get_version()
+    _sync_index_version(version)
+    await _load_vectors(index, version)
+
+async def get_exact(question: str, request_id=None) -> Optional[str]:
+    """Return the answer cached for exactly this normalized question, without a similarity search"""
+    return await get_value(_answer_key(normalize_question(question)), request_id)
+
+async def lookup_exact(question: str, request_id=None) -> Optional[str]:
+    """Return the answer cached for the normalized question, counted as a cache hit"""
+    start_time = time.perf_counter()
+    await _sync_index(await get_version())
+    answer = await get_value(_answer_key(normalize_question(question)), request_id)
+    if answer:
+        stats["hits"] += 1
+    metrics.cache_lookup_seconds.observe(time.perf_counter() - start_time, "exact", "hit" if answer else "miss")
+    return answer
+
+async def lookup_similar(question: str, request_id=None) -> Optional[str]:
+    """
+    Return the cached answer of a semantically similar question, after the exact key missed
+    Embeds the question, which costs an embeddings API call unless it was embedded recently
+    """
+    start_time = time.perf_counter()
+    answer = await _lookup_similar(question, request_id)
+    metrics.cache_lookup_seconds.observe(time.perf_counter() - start_time, "semantic", "hit" if answer else "miss")
+    return answer
+
+async def _lookup_similar(question: str, request_id=None) -> Optional[str]:
+    normalized = normalize_question(question)
+    try:
+        matches = index.search(await _embed(normalized), SEMANTIC_CACHE_CANDIDATES)
+    except Exception as e:
+        logger.error("Error searching semantic cache: %s", e, extra={"request_id": request_id})
+        matches = []
+    candidates = []
+    for key, score in matches:
+        if score < similarity_threshold:
+            break
+        if _same_details(normalized, key):
+            candidates.append((key, score))
+        else:
+            logger.info("Semantic cache candidate with similarity %.3f differs in numbers or entities", score, extra={"request_id": request_id})
+    if candidates:
+        # The answer of a candidate may have expired or been evicted from Redis, the first live one is the match
+        answers = await get_values([_answer_key(key) for key, _ in candidates], request_id)
+        for (key, score), answer in zip(candidates, answers):
+            if answer:
+                logger.info("Semantic cache match with similarity %.3f", score, extra={"request_id": request_id})
+                stats["semantic_hits"] += 1
+                return answer
+    stats["misses"] += 1
+    return None
+
+async def get_exact_many(questions: List[str], request_id=None) -> Dict[str, str]:
+    """
+    Answers cached for exactly these normalized questions, fetched with a single Redis MGET
+
+    Returns:
+        Dict[str, str]: Answer by normalized question, for the questions with a cached answer
+    """
+    normalized = list(dict.fromkeys(normalize_question(question) for question in questions))
+    await _sync_index(await get_version())
+    answers = await get_values([_answer_key(key) for key in normalized], request_id)
+    found = {key: answer for key, answer in zip(normalized, answers) if answer}
+    stats["hits"] += len(found)
+    return found
+
+async def store(question: str, answer: str, request_id=None, similar=True) -> bool:
+    """
+    Cache the answer under the normalized question and, when similar questions should find it, index its embedding
+    Cheap answers such as the fast path's are stored without embedding and only match the exact question
+    """
+    normalized = normalize_question(question)
+    await _sync_index(await get_version())
+    if not await set_key_value(_answer_key(normalized), answer, request_id):
+        return False
+    if not similar:
+        return True
+    try:
+        vector = await _embed(normalized)
+        added_at = time.time()
+        evicted = index.add(normalized, vector, added_at)
+        vectors_key = await namespaced(VECTORS_KEY)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(vectors_key, normalized, _encode_entry(vector, added_at))
+            if evicted:
+                pipe.hdel(vectors_key, *evicted)
+            pipe.expire(vectors_key, CACHE_TTL_SECONDS)
+            await pipe.execute()
+        if index.needs_training():
+            _in_background(index.train())
+    except Exception as e:
+        logger.error("Error indexing question in semantic cache: %s", e, extra={"request_id": request_id})
+    return True
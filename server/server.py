@@ -1,17 +1,75 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from agent import graph, langfuse_callback
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+from agent import get_graph, get_langfuse_callback
 from graph_tools import character_neighbors
-from typing import Dict, Any
-from cache_server import set_key_value, get_value
+from typing import Dict, Any, List, Optional, Tuple
 from logger import logger
 from dotenv import load_dotenv
+import semantic_cache
+import single_flight
+import router
+import cache_server
+import graph_tools
+import metrics
+import batch
+import asyncio
+import json
+import time
 import os
 import uvicorn
 import uuid
 
 load_dotenv(override=True)
-app = FastAPI()
+
+# Startup waits for the warm up at most STARTUP_BUDGET_SECONDS, then the server accepts requests and
+# reports not ready until the warm up, retried every WARMUP_RETRY_SECONDS, succeeds
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", 0.5))
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", 5))
+
+startup = {"ready": False, "startup_seconds": None, "warm_up_seconds": None, "error": None}
+
+async def warm_up():
+    """Connect to Redis and Neo4j, load the in-memory indexes and build the workflow"""
+    start_time = time.perf_counter()
+    while True:
+        try:
+            await cache_server.connect()
+            cache_server.start_invalidation_listener()
+            await graph_tools.verify_connectivity()
+            await graph_tools.warm_up()
+            await graph_tools.reload_graph()
+            await graph_tools.current_schema()
+            semantic_cache.get_embedder()
+            await semantic_cache.load_index()
+            await router.load_index()
+            get_graph()
+            break
+        except Exception as e:
+            startup["error"] = str(e)
+            logger.error("Warm up failed, retrying in %ss: %s", WARMUP_RETRY_SECONDS, e)
+            await asyncio.sleep(WARMUP_RETRY_SECONDS)
+    startup.update(ready=True, error=None, warm_up_seconds=round(time.perf_counter() - start_time, 3))
+    logger.info("Warm up finished in %ss, server is ready", startup["warm_up_seconds"])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the clients and indexes in the background on startup and release them on shutdown"""
+    start_time = time.perf_counter()
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        await asyncio.wait_for(asyncio.shield(warm_up_task), timeout=STARTUP_BUDGET_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Warm up exceeds the startup budget of %ss, continuing in the background", STARTUP_BUDGET_SECONDS)
+    startup["startup_seconds"] = round(time.perf_counter() - start_time, 3)
+    logger.info("Server started in %ss", startup["startup_seconds"])
+    yield
+    warm_up_task.cancel()
+    await cache_server.close()
+    await graph_tools.close()
+
+app = FastAPI(lifespan=lifespan)
 
 class QuestionRequest(BaseModel):
     question: str
@@ -19,57 +77,275 @@ class QuestionRequest(BaseModel):
 class QuestionResponse(BaseModel):
     response: str
 
+class BatchRequest(BaseModel):
+    questions: List[str] = Field(min_length=1, max_length=batch.BATCH_MAX_QUESTIONS)
+
+class BatchItem(BaseModel):
+    question: str
+    response: Optional[str] = None
+    error: Optional[str] = None
+    cached: bool = False
+
+class BatchResponse(BaseModel):
+    results: List[BatchItem]
+
+class BatchJob(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    unique: int
+    completed: int
+    submitted_at: float
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    results: Optional[List[BatchItem]] = None
+
+def workflow_input(question: str) -> Dict[str, Any]:
+    return {
+        "messages": [
+            ("user", question)
+        ]
+    }
+
+def workflow_config(request_id: str) -> Dict[str, Any]:
+    return {
+        "callbacks": [get_langfuse_callback()],
+        "metadata": {
+            "request_id": request_id,
+        },
+    }
+
+async def run_workflow(question: str, request_id: str) -> str:
+    """Run the agentic workflow for a question and cache its answer, partial answers of a stopped workflow are not cached"""
+    start_time = time.perf_counter()
+    try:
+        response = await get_graph().ainvoke(workflow_input(question), config=workflow_config(request_id))
+    except Exception:
+        metrics.workflow_seconds.observe(time.perf_counter() - start_time, "invoke", "error")
+        raise
+    metrics.workflow_seconds.observe(time.perf_counter() - start_time, "invoke", "ok")
+    message = response['messages'][-1]
+    if not message.response_metadata.get("partial"):
+        await semantic_cache.store(question, message.content, request_id)
+    return message.content
+
+async def fast_path(question: str, request_id: str) -> Optional[str]:
+    """Answer of the router for a templated question, cached for the exact question without embedding it"""
+    answer = await router.route(question, request_id)
+    if answer:
+        await semantic_cache.store(question, answer, request_id, similar=False)
+    return answer
+
+async def answer_question(question: str, request_id: str) -> Tuple[str, bool]:
+    """
+    Answer a question whose exact key missed the cache: through the fast path, then from the answer of a
+    semantically similar question and last through the agentic workflow. The fast path comes before the
+    similarity search, which embeds the question
+
+    Returns:
+        Tuple[str, bool]: The answer and whether it came from the cache
+    """
+    answer = await fast_path(question, request_id)
+    if answer:
+        return answer, False
+    answer = await semantic_cache.lookup_similar(question, request_id)
+    if answer:
+        logger.info("Semantic cache hit, returning answer from cache", extra={"request_id": request_id})
+        return answer, True
+    logger.info("Cache miss, triggering agentic workflow", extra={"request_id": request_id})
+    answer = await single_flight.run(
+        semantic_cache.normalize_question(question),
+        lambda: run_workflow(question, request_id),
+        lambda: semantic_cache.get_exact(question, request_id),
+        request_id,
+    )
+    return answer, False
+
 @app.post("/question", response_model=QuestionResponse)
 async def ask_question(request: QuestionRequest):
     """Process a user question using the X-Men agent"""
     request_id = str(uuid.uuid4())
-    logger.info(f'/question request_id {request_id}')
+    logger.info("/question", extra={"request_id": request_id})
     question = request.question
-    cache_result = get_value(question, request_id)
+    cache_result = await semantic_cache.lookup_exact(question, request_id)
     if cache_result:
-        logger.info(f"Cache hit, returning answer from cache, request_id {request_id}")
+        logger.info("Cache hit, returning answer from cache", extra={"request_id": request_id})
         return QuestionResponse(response=cache_result)
-    else:
-        logger.info(f"Cache miss, triggering agentic workflow, request_id {request_id}")
-    input = {
-        "messages": [
-            ("user", question)
-        ]
-    }
     try:
-        response = graph.invoke(
-            input, 
-            config={
-                "callbacks": [langfuse_callback],
-                "metadata": {
-                    "request_id": request_id,
-                },
-            }
-        )
-        answer = response['messages'][-1].content
-        set_key_value(question, answer, request_id)
-        logger.info(f'returning answer, request_id {request_id}')
+        answer, _ = await answer_question(question, request_id)
+        logger.info("returning answer", extra={"request_id": request_id})
         return QuestionResponse(response=answer)
     except Exception as e:
-        logger.error(f'Returning 500, got Error: {e}, request_id {request_id}')
+        logger.error("Returning 500, got Error: %s", e, extra={"request_id": request_id})
         logger.exception(e)
         raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
 
+@app.post("/questions/batch", response_model=BatchResponse)
+async def ask_questions_batch(request: BatchRequest):
+    """
+    Process many questions at once: duplicates are answered once, cached answers are fetched together
+    and the rest run at most BATCH_CONCURRENCY at a time. Failures are reported per question
+    """
+    request_id = str(uuid.uuid4())
+    logger.info("/questions/batch", extra={"request_id": request_id})
+    results = await batch.answer_batch(request.questions, answer_question, request_id)
+    return BatchResponse(results=results)
+
+@app.post("/questions/batch/jobs", response_model=BatchJob, status_code=202)
+async def submit_questions_batch(request: BatchRequest):
+    """Start processing many questions in the background, poll /questions/batch/jobs/{job_id} for the results"""
+    job = await batch.submit_job(request.questions, answer_question)
+    logger.info("/questions/batch/jobs", extra={"request_id": job["job_id"]})
+    return job
+
+@app.get("/questions/batch/jobs/{job_id}", response_model=BatchJob)
+async def get_questions_batch(job_id: str):
+    """Status and progress of a batch job, with the results once done"""
+    job = await batch.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch job '{job_id}' not found")
+    return job
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_workflow(question: str, request_id: str):
+    """
+    Run the agentic workflow and yield Server-Sent Events as it progresses:
+    'token' for each LLM token, 'tool_call' and 'tool_result' for each tool invocation,
+    'answer' with the final answer and 'error' if the workflow fails
+    """
+    cache_result = await semantic_cache.lookup_exact(question, request_id)
+    if cache_result:
+        logger.info("Cache hit, streaming answer from cache", extra={"request_id": request_id})
+        yield sse_event("answer", {"response": cache_result, "cached": True})
+        return
+
+    answer = None
+    partial = False
+    start_time = None
+    try:
+        answer = await fast_path(question, request_id)
+        if answer:
+            yield sse_event("answer", {"response": answer, "cached": False})
+            return
+        cache_result = await semantic_cache.lookup_similar(question, request_id)
+        if cache_result:
+            logger.info("Semantic cache hit, streaming answer from cache", extra={"request_id": request_id})
+            yield sse_event("answer", {"response": cache_result, "cached": True})
+            return
+        logger.info("Cache miss, streaming agentic workflow", extra={"request_id": request_id})
+        start_time = time.perf_counter()
+        async for event in get_graph().astream_events(workflow_input(question), config=workflow_config(request_id), version="v2"):
+            kind = event["event"]
+            if kind == "on_chat_model_stream":
+                content = event["data"]["chunk"].content
+                if content:
+                    yield sse_event("token", {"content": content})
+            elif kind == "on_chat_model_end":
+                output = event["data"]["output"]
+                if not output.tool_calls:
+                    answer = output.content
+            elif kind == "on_tool_start":
+                yield sse_event("tool_call", {"name": event["name"], "input": event["data"].get("input")})
+            elif kind == "on_tool_end":
+                output = event["data"].get("output")
+                yield sse_event("tool_result", {"name": event["name"], "output": str(getattr(output, "content", output))})
+            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                # The final state of the workflow, also covers answers not written by the LLM (direct tool results, partial answers)
+                message = event["data"]["output"]["messages"][-1]
+                answer = message.content
+                partial = bool(message.response_metadata.get("partial"))
+    except Exception as e:
+        logger.error("Streaming workflow failed, got Error: %s", e, extra={"request_id": request_id})
+        logger.exception(e)
+        if start_time is not None:
+            metrics.workflow_seconds.observe(time.perf_counter() - start_time, "stream", "error")
+        yield sse_event("error", {"detail": f"Error processing question: {str(e)}"})
+        return
+
+    metrics.workflow_seconds.observe(time.perf_counter() - start_time, "stream", "ok" if answer is not None else "error")
+    if answer is None:
+        yield sse_event("error", {"detail": "Workflow finished without an answer"})
+        return
+    if not partial:
+        await semantic_cache.store(question, answer, request_id)
+    logger.info("streamed answer", extra={"request_id": request_id})
+    yield sse_event("answer", {"response": answer, "cached": False, "partial": partial})
+
+@app.post("/question/stream")
+async def ask_question_stream(request: QuestionRequest):
+    """Process a user question using the X-Men agent, streaming progress as Server-Sent Events"""
+    request_id = str(uuid.uuid4())
+    logger.info("/question/stream", extra={"request_id": request_id})
+    return StreamingResponse(
+        stream_workflow(request.question, request_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/health/live")
+async def liveness() -> Dict[str, Any]:
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Ready once warmed up and while Redis answers, otherwise 503"""
+    status = dict(startup)
+    if status["ready"]:
+        try:
+            await asyncio.wait_for(cache_server.redis_client.ping(), timeout=1)
+        except Exception as e:
+            status.update(ready=False, error=f"Redis unavailable: {e}")
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.get("/cache/stats")
+async def get_cache_stats() -> Dict[str, Any]:
+    """Answer cache hit/miss counters and Redis eviction counters"""
+    return await cache_server.cache_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Latency histograms and counters of the pipeline in the Prometheus text format"""
+    return PlainTextResponse(
+        metrics.render({"marvel_cache_events_total": cache_server.stats}),
+        media_type="text/plain; version=0.0.4",
+    )
+
 @app.get("/graph/{character}")
-async def get_character_graph(character: str) -> Dict[str, Any]:
-    """Get character's immediate neighbors in the graph"""
+async def get_character_graph(
+    character: str,
+    depth: int = Query(1, ge=1, le=graph_tools.GRAPH_MAX_DEPTH),
+    min_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+    limit: int = Query(graph_tools.GRAPH_NEIGHBOR_LIMIT, ge=1, le=graph_tools.GRAPH_NEIGHBOR_LIMIT),
+) -> Dict[str, Any]:
+    """
+    Get character's neighbors in the graph, the name is matched case insensitively and tolerates typos
+    depth above 1 adds the neighborhood within depth hops, min_confidence skips less confident
+    relationships and limit caps the neighbors per node and relationship type
+    """
     request_id = str(uuid.uuid4())
-    logger.info(f'/graph/{character}: {request_id}')
+    logger.info("/graph/%s", character, extra={"request_id": request_id})
     try:
-        result = character_neighbors(character, request_id)
+        character_name = await graph_tools.resolve_name("Character", character, request_id)
+        if character_name is None:
+            logger.error("Returning 404, no character matches %s", character, extra={"request_id": request_id})
+            raise HTTPException(status_code=404, detail=f"Character '{character}' not found")
+        if character_name != character:
+            logger.info("Resolved character %s to %s", character, character_name, extra={"request_id": request_id})
+        result = await character_neighbors(character_name, request_id, depth, min_confidence, limit)
         if "error" in result:
-            logger.error(f'Returning 404 for error from querying character neighbors: {result["error"]}, request_id {request_id}')
+            logger.error("Returning 404 for error from querying character neighbors: %s", result["error"], extra={"request_id": request_id})
             raise HTTPException(status_code=404, detail=result["error"])
         else:
-            logger.info(f'Got result from getting character neighbors: {result}, request_id {request_id}')
+            logger.debug("Got result from getting character neighbors: %s", result, extra={"request_id": request_id})
         return result
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f'Returning 500, got Error: {e}, request_id {request_id}')
+        logger.error("Returning 500, got Error: %s", e, extra={"request_id": request_id})
         logger.exception(e)
         raise HTTPException(status_code=500, detail=f"Error retrieving character data: {str(e)}")
 
@@ -79,5 +355,5 @@ if __name__ == "__main__":
         main()
 
     server_port = int(os.getenv('SERVER_PORT'))
-    logger.info(f'Server is listening at port {server_port}')
+    logger.info("Server is listening at port %s", server_port)
     uvicorn.run(app, host="0.0.0.0", port=server_port)
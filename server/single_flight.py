@@ -0,0 +1,93 @@
+from dotenv import load_dotenv
+from logger import logger
+from cache_server import redis_client, namespaced, stats
+from typing import Awaitable, Callable, Optional
+import asyncio
+import uuid
+import os
+
+load_dotenv()
+
+SINGLE_FLIGHT_LEASE_SECONDS = float(os.getenv("SINGLE_FLIGHT_LEASE_SECONDS", 120))
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", 0.2))
+SINGLE_FLIGHT_MAX_POLL_SECONDS = 1.0
+
+# Deletes the lease only if it is still held by the caller
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_in_flight = {}
+
+async def _acquire(lock_key: str, token: str) -> bool:
+    return bool(await redis_client.set(lock_key, token, nx=True, px=int(SINGLE_FLIGHT_LEASE_SECONDS * 1000)))
+
+async def _release(lock_key: str, token: str):
+    try:
+        await redis_client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+    except Exception as e:
+        logger.error("Error releasing single flight lease %s: %s", lock_key, e)
+
+async def _run_distributed(key: str, compute: Callable[[], Awaitable[str]],
+                           lookup: Callable[[], Awaitable[Optional[str]]], request_id=None) -> str:
+    """
+    Run compute while holding a Redis lease for the key, or wait for the replica holding it
+    A follower polls lookup until the leader's answer is cached, and takes over the lease if it
+    expires or is released without an answer
+    """
+    token = uuid.uuid4().hex
+    poll_seconds = SINGLE_FLIGHT_POLL_SECONDS
+    try:
+        lock_key = await namespaced(f"lock:{key}")
+        while not await _acquire(lock_key, token):
+            await asyncio.sleep(poll_seconds)
+            poll_seconds = min(2 * poll_seconds, SINGLE_FLIGHT_MAX_POLL_SECONDS)
+            answer = await lookup()
+            if answer:
+                stats["coalesced_remote"] += 1
+                logger.info("Received answer computed by another replica", extra={"request_id": request_id})
+                return answer
+    except Exception as e:
+        logger.error("Single flight lease unavailable, computing without it: %s", e, extra={"request_id": request_id})
+        return await compute()
+
+    try:
+        # The answer may have been cached between the caller's lookup and acquiring the lease
+        answer = await lookup()
+        if answer:
+            return answer
+        return await compute()
+    finally:
+        await _release(lock_key, token)
+
+async def run(key: str, compute: Callable[[], Awaitable[str]],
+              lookup: Callable[[], Awaitable[Optional[str]]], request_id=None) -> str:
+    """
+    Deduplicate concurrent computations of the same key
+
+    Within the process, concurrent callers with the same key share one computation. Across
+    replicas the computation is guarded by a Redis lease and the other replicas wait for the
+    result to appear through lookup
+
+    Args:
+        key (str): Normalized question
+        compute: Coroutine function producing the answer and caching it
+        lookup: Coroutine function returning the cached answer or None
+        request_id: Request id used for logging
+
+    Returns:
+        str: The answer computed by the leader
+    """
+    task = _in_flight.get(key)
+    if task is not None:
+        stats["coalesced_local"] += 1
+        logger.info("Waiting for in-flight workflow of identical question", extra={"request_id": request_id})
+    else:
+        # The computation runs in its own task so a disconnecting leader does not cancel it for the followers
+        task = asyncio.create_task(_run_distributed(key, compute, lookup, request_id))
+        _in_flight[key] = task
+        task.add_done_callback(lambda done: _in_flight.pop(key) if _in_flight.get(key) is done else None)
+    return await asyncio.shield(task)
@@ -0,0 +1,42 @@
+import pytest
+import router
+from name_index import NameIndex, normalize_name
+
+NAMES = ["Professor X", "The Hulk", "Wolverine", "Spider-Man", "Storm", "Magneto", "Mystique", "Iceman"]
+
+@pytest.fixture
+def index():
+    return NameIndex({"Character": NAMES, "Team": ["X-Men", "X-Force"]})
+
+def test_normalize_name():
+    assert normalize_name("  Spider-Man ") == "spider man"
+    assert normalize_name("The Hulk") == "the hulk"
+
+@pytest.mark.parametrize("text, name", [
+    ("Professor X", "Professor X"),
+    ("professor xavier", "Professor X"),
+    ("prof x", "Professor X"),
+    ("hulk", "The Hulk"),
+    ("the hulk", "The Hulk"),
+    ("wolverin", "Wolverine"),
+    ("spiderman", "Spider-Man"),
+])
+def test_resolve(index, text, name):
+    assert index.resolve("Character", text) == name
+
+@pytest.mark.parametrize("text", ["m", "s", "x"])
+def test_single_letters_do_not_resolve(index, text):
+    assert index.resolve("Character", text) is None
+
+def test_one_letter_name_token_is_not_a_prefix(index):
+    matches = index.match("Character", "professor xylophone")
+    assert matches[0][0] == "Professor X" and matches[0][1] < router.FAST_PATH_NAME_THRESHOLD
+    assert index.resolve("Character", "professor xylophone", router.FAST_PATH_NAME_THRESHOLD) is None
+
+def test_near_ties_are_ambiguous():
+    index = NameIndex({"Team": ["X-Men", "X-Man", "X-Force"]})
+    assert index.resolve("Team", "x mxn") is None
+    assert index.resolve("Team", "x men") == "X-Men"
+
+def test_mentions(index):
+    assert index.mentions("Is Hulk stronger than Storm?") == {("Character", "The Hulk"), ("Character", "Storm")}
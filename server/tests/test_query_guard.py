@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+import asyncio
+import pytest
+import query_guard
+from query_guard import QueryRejected
+
+@pytest.mark.parametrize("cypher_query", [
+    'MATCH p=(start:Character {name:"Wolverine"})-[*1..2]-(other) RETURN other.name',
+    'MATCH (c:Character) WITH c, c.name AS set RETURN set',
+    'MATCH (start)-[r]->(end) RETURN start.name, end.name',
+    'MATCH (stop:Character), (rename:Team) RETURN stop.name AS terminate, rename.name AS remove',
+    'MATCH (c:Character {name: "CREATE (x)"}) RETURN c.name // SET c.name = 1',
+    'MATCH (c:Character) WHERE c.set = 1 AND c.create IS NULL RETURN c',
+    'CALL db.labels()',
+])
+def test_validate_accepts_read_queries(cypher_query):
+    assert query_guard.validate(cypher_query + ";") == cypher_query
+
+@pytest.mark.parametrize("cypher_query, clause", [
+    ('CREATE (c:Character {name: "X"})', "CREATE"),
+    ('MATCH (c) MERGE (c)-[:MEMBER_OF]->(:Team {name: "X"})', "MERGE"),
+    ('MATCH (c) DETACH DELETE c', "DETACH DELETE"),
+    ('MATCH (c) SET c.name = "X"', "SET"),
+    ('MATCH (c) SET c:Mutant', "SET"),
+    ('MATCH (c) SET c += {name: "X"}', "SET"),
+    ('MATCH (c) REMOVE c.name', "REMOVE"),
+    ('MATCH (c) FOREACH (x IN [1] | SET c.n = x)', "FOREACH"),
+    ('LOAD CSV FROM "file:///x.csv" AS row RETURN row', "LOAD CSV"),
+    ('DROP INDEX character_name', "DROP"),
+    ('CREATE CONSTRAINT FOR (c:Character) REQUIRE c.name IS UNIQUE', "CREATE"),
+])
+def test_validate_rejects_obvious_writes(cypher_query, clause):
+    with pytest.raises(QueryRejected) as rejected:
+        query_guard.validate(cypher_query)
+    assert rejected.value.reason == "read_only"
+    assert f"{clause} is not allowed" in rejected.value.message
+
+@pytest.mark.parametrize("cypher_query, reason", [
+    ("  ", "empty_query"),
+    ("// only a comment", "empty_query"),
+    ("MATCH (n) RETURN n; MATCH (m) RETURN m", "multiple_statements"),
+    ("EXPLAIN MATCH (n) RETURN n", "not_allowed"),
+    ("PROFILE MATCH (n) RETURN n", "not_allowed"),
+    ("CALL dbms.killQuery('1')", "not_allowed"),
+])
+def test_validate_rejects(cypher_query, reason):
+    with pytest.raises(QueryRejected) as rejected:
+        query_guard.validate(cypher_query)
+    assert rejected.value.reason == reason
+
+def test_costliest_operator():
+    plan = {
+        "operatorType": "ProduceResults@neo4j", "args": {"EstimatedRows": 10.0},
+        "children": [
+            {"operatorType": "Expand(All)@neo4j", "args": {"EstimatedRows": 5000.0}, "children": [
+                {"operatorType": "AllNodesScan@neo4j", "args": {"EstimatedRows": 100.0}},
+            ]},
+            {"operatorType": "NodeByLabelScan@neo4j", "args": {}},
+        ],
+    }
+    assert query_guard._costliest_operator(plan) == (5000.0, "Expand(All)")
+    assert query_guard._costliest_operator({}) == (0.0, "unknown")
+
+class ExplainTx:
+    def __init__(self, query_type, plan):
+        self.summary = SimpleNamespace(query_type=query_type, plan=plan)
+        self.queries = []
+
+    async def run(self, cypher_query):
+        self.queries.append(cypher_query)
+        summary = self.summary
+
+        class Result:
+            async def consume(self):
+                return summary
+        return Result()
+
+def test_check_plan_accepts_cheap_read():
+    tx = ExplainTx("r", {"operatorType": "NodeIndexSeek", "args": {"EstimatedRows": 1.0}})
+    asyncio.run(query_guard.check_plan(tx, "MATCH (n) RETURN n"))
+    assert tx.queries == ["EXPLAIN MATCH (n) RETURN n"]
+
+@pytest.mark.parametrize("query_type", ["rw", "w", "s"])
+def test_check_plan_rejects_writes(query_type):
+    with pytest.raises(QueryRejected) as rejected:
+        asyncio.run(query_guard.check_plan(ExplainTx(query_type, None), "MATCH (n) DELETE n"))
+    assert rejected.value.reason == "read_only"
+
+def test_check_plan_rejects_expensive_plan():
+    tx = ExplainTx("r", {"operatorType": "CartesianProduct@neo4j", "args": {"EstimatedRows": 1e9}})
+    with pytest.raises(QueryRejected) as rejected:
+        asyncio.run(query_guard.check_plan(tx, "MATCH (a), (b) RETURN a, b", max_estimated_rows=1000))
+    assert rejected.value.reason == "too_expensive"
+    assert "CartesianProduct" in rejected.value.message
@@ -0,0 +1,25 @@
+import pytest
+import router
+
+@pytest.fixture(autouse=True)
+def names(monkeypatch):
+    monkeypatch.setattr(router, "_names", {"x men": ("Team", "X-Men"), "flight": ("Power", "Flight")})
+    monkeypatch.setattr(router, "_max_name_words", 2)
+
+def test_normalize_text_keeps_comparisons():
+    assert router.normalize_text("Members of X-Men with confidence>=0.5?") == "members of x men with confidence >= 0.5"
+    assert router.normalize_text("confidence ≥ 0.5, rank = 1") == "confidence >= 0.5 rank 1"
+
+@pytest.mark.parametrize("question, min_confidence, inclusive", [
+    ("members of team X-Men with confidence > 0.5", 0.5, False),
+    ("members of team X-Men with confidence >= 0.5", 0.5, True),
+    ("members of the X-Men with confidence of at least 0.5", 0.5, True),
+    ("members of X-Men with a confidence higher than 0.5", 0.5, False),
+    ("members of X-Men with confidence greater than or equal to 0.5", 0.5, True),
+    ("members of team X-Men", 0.0, False),
+])
+def test_match_intent_confidence(question, min_confidence, inclusive):
+    assert router.match_intent(question) == ("members", {"Team": "X-Men"}, min_confidence, inclusive)
+
+def test_match_intent_power_holders():
+    assert router.match_intent("who has the power Flight with confidence ≥ 0.9") == ("power_holders", {"Power": "Flight"}, 0.9, True)
@@ -0,0 +1,73 @@
+import asyncio
+import numpy as np
+import semantic_cache
+from semantic_cache import VectorIndex
+
+def vector(*values):
+    return np.array(values, dtype=np.float32)
+
+def test_search_returns_best_first():
+    index = VectorIndex(2)
+    index.add("x", vector(1, 0))
+    index.add("y", vector(0, 1))
+    index.add("xy", vector(1, 1))
+    assert [key for key, _ in index.search(vector(1, 0.1), k=2)] == ["x", "xy"]
+    assert len(index.search(vector(1, 0), k=10)) == 3
+
+def test_expired_entries_are_skipped_and_evicted():
+    index = VectorIndex(2, ttl_seconds=100)
+    index.add("old", vector(1, 0), added_at=0)
+    index.add("new", vector(1, 0.2))
+    assert [key for key, _ in index.search(vector(1, 0), k=2)] == ["new"]
+    assert index.evict() == ["old"]
+    assert "old" not in index and len(index) == 1
+
+def test_size_bound_evicts_the_oldest():
+    index = VectorIndex(2, max_size=10)
+    evicted = []
+    for i in range(11):
+        evicted += index.add(f"q{i}", vector(1, i), added_at=i)
+    assert evicted == ["q0", "q1"]
+    assert len(index) == 9
+    assert [key for key, _ in index.search(vector(1, 10))] == ["q10"]
+
+def test_compaction_keeps_partitions():
+    index = VectorIndex(2, max_size=100, ivf_threshold=40, nprobe=100)
+    rng = np.random.default_rng(1)
+    for i in range(40):
+        index.add(f"q{i}", rng.normal(size=2), added_at=i)
+    asyncio.run(index.train())
+    for i in range(40, 100):
+        index.add(f"q{i}", rng.normal(size=2), added_at=i)
+    index.ttl_seconds = 1000
+    index.evict(now=1070)
+    assert len(index) == 30 and len(index._keys) == 30
+    index.ttl_seconds = None
+    target = rng.normal(size=2)
+    index.add("target", target)
+    assert index.search(target)[0][0] == "target"
+    assert sorted(row for partition in index._partitions for row in partition) == list(range(31))
+
+def test_entry_encoding():
+    encoded = semantic_cache._encode_entry(vector(0.5, 1), 123.5)
+    decoded, added_at = semantic_cache._decode_entry(encoded, 2)
+    assert added_at == 123.5 and decoded.tolist() == [0.5, 1.0]
+    assert semantic_cache._decode_entry(vector(0.5, 1).tobytes(), 2) is None
+
+def test_lookup_skips_candidates_without_a_live_answer(monkeypatch):
+    index = VectorIndex(2)
+    index.add("who leads x men", vector(1, 0))
+    index.add("who leads the x men", vector(1, 0.01))
+    answers = {"answer:who leads the x men": "Cyclops"}
+
+    async def embed(normalized):
+        return vector(1, 0)
+
+    async def get_values(keys, request_id=None):
+        return [answers.get(key) for key in keys]
+
+    monkeypatch.setattr(semantic_cache, "index", index)
+    monkeypatch.setattr(semantic_cache, "_embed", embed)
+    monkeypatch.setattr(semantic_cache, "get_values", get_values)
+    monkeypatch.setattr(semantic_cache, "_same_details", lambda normalized, other: True)
+    assert asyncio.run(semantic_cache._lookup_similar("Who is leading the X-Men?")) == "Cyclops"
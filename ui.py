@@ -11,34 +11,63 @@ SERVER_HOST = os.getenv('SERVER_HOST', 'localhost')
 SERVER_PORT = os.getenv('SERVER_PORT', '8000')
 BASE_URL = f"http://{SERVER_HOST}:{SERVER_PORT}"
 
+def iter_sse_events(response):
+    """Parse a Server-Sent Events response into (event, data) pairs"""
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
+
 def ask_question(question):
-    """Send question to the /question endpoint"""
+    """Send question to the /question/stream endpoint and render the answer as it streams in"""
     if not question.strip():
-        return "Please enter a question."
+        yield "Please enter a question."
+        return
     
     try:
         payload = {"question": question}
-        response = requests.post(
-            f"{BASE_URL}/question",
+        with requests.post(
+            f"{BASE_URL}/question/stream",
             json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result.get("response", "No response received")
-        else:
-            return f"Error {response.status_code}: {response.text}"
+            headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+            stream=True,
+            timeout=(5, 120)
+        ) as response:
+            if response.status_code != 200:
+                yield f"Error {response.status_code}: {response.text}"
+                return
+
+            steps = []
+            answer = ""
+            for event, data in iter_sse_events(response):
+                if event == "token":
+                    answer += data["content"]
+                elif event == "tool_call":
+                    steps.append(f"🔧 {data['name']}: {json.dumps(data['input'])}")
+                    answer = ""
+                elif event == "tool_result":
+                    steps.append(f"📄 {data['name']} returned {len(data['output'])} characters")
+                elif event == "answer":
+                    answer = data["response"]
+                elif event == "error":
+                    answer = f"❌ {data['detail']}"
+                progress = "\n".join(steps)
+                yield f"{progress}\n\n{answer}" if progress else answer
             
     except requests.exceptions.ConnectionError:
-        return f"❌ Connection Error: Could not connect to server at {BASE_URL}. Make sure the server is running."
+        yield f"❌ Connection Error: Could not connect to server at {BASE_URL}. Make sure the server is running."
     except requests.exceptions.Timeout:
-        return "⏰ Request timed out. The server might be processing a complex query."
+        yield "⏰ Request timed out. The server might be processing a complex query."
     except Exception as e:
-        return f"❌ Error: {str(e)}"
+        yield f"❌ Error: {str(e)}"
 
-def get_character_graph(character_name):
+def get_character_graph(character_name, depth=1):
     """Get character graph from the /graph/{character} endpoint"""
     if not character_name.strip():
         return "Please enter a character name."
@@ -46,6 +75,7 @@ def get_character_graph(character_name):
     try:
         response = requests.get(
             f"{BASE_URL}/graph/{character_name}",
+            params={"depth": int(depth)},
             timeout=10
         )
         
@@ -95,7 +125,7 @@ with gr.Blocks(title="X-Men Agent Server Tester", theme=gr.themes.Soft()) as app
     # Question asking interface
     with gr.Tab("Ask Questions"):
         gr.Markdown("### Ask the X-Men Agent a Question")
-        gr.Markdown("This uses the `/question` endpoint to process your question through the agentic workflow.")
+        gr.Markdown("This uses the `/question/stream` endpoint to process your question through the agentic workflow, showing its steps and answer as they are produced.")
         
         with gr.Row():
             with gr.Column(scale=3):
@@ -137,7 +167,7 @@ with gr.Blocks(title="X-Men Agent Server Tester", theme=gr.themes.Soft()) as app
     # Character graph interface
     with gr.Tab("Character Graph"):
         gr.Markdown("### Explore Character Relationships")
-        gr.Markdown("This uses the `/graph/{character}` endpoint to get a character's immediate neighbors in the graph.")
+        gr.Markdown("This uses the `/graph/{character}` endpoint to get a character's neighbors in the graph, up to the selected depth.")
         
         with gr.Row():
             with gr.Column(scale=3):
@@ -146,6 +176,14 @@ with gr.Blocks(title="X-Men Agent Server Tester", theme=gr.themes.Soft()) as app
                     placeholder="e.g., Wolverine, Storm, Professor X",
                     lines=1
                 )
+            with gr.Column(scale=1):
+                depth_input = gr.Slider(
+                    minimum=1,
+                    maximum=3,
+                    step=1,
+                    value=1,
+                    label="Depth"
+                )
             with gr.Column(scale=1):
                 graph_btn = gr.Button("Get Graph", variant="primary", size="lg")
         
@@ -183,7 +221,7 @@ with gr.Blocks(title="X-Men Agent Server Tester", theme=gr.themes.Soft()) as app
     
     graph_btn.click(
         get_character_graph,
-        inputs=character_input,
+        inputs=[character_input, depth_input],
         outputs=graph_output
     )
     
@@ -196,7 +234,7 @@ with gr.Blocks(title="X-Men Agent Server Tester", theme=gr.themes.Soft()) as app
     
     character_input.submit(
         get_character_graph,
-        inputs=character_input,
+        inputs=[character_input, depth_input],
         outputs=graph_output
     )
     